@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+"""Benchmark the hook runners and input parsers on synthetic repos
+
+Builds git (and hg, when it is installed) repos of the requested sizes in
+a work directory, then runs a small hook suite through runhooks in a fresh
+interpreter for each invocation, like git and hg do, for each phase and
+runner mode. Reports latency percentiles, the cost of the input parsing,
+the number of processes started (from HOOKLIB_PROFILE) and the peak RSS of
+the hook process. The repos are deterministic and kept in the work
+directory to be reused by later runs.
+
+    python hookbench.py --sizes 10,1000,100000 --output results.json
+    python hookbench.py --sizes 10,1000 --baseline results.json
+
+With --baseline, exits with an error when a measure regressed by more than
+--tolerance compared to the stored results."""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MODES = {
+    'sequential': 'False',
+    'thread': 'True',
+    'process': "'process'",
+    'async': "'async'",
+    'scheduled': "'scheduled'",
+}
+PHASES = {
+    'git': ['update', 'pre-receive', 'post-update'],
+    'hg': ['update'],
+}
+# Time of the first synthetic commit, fixed for the shas to be reproducible
+EPOCH = 1500000000
+
+HOOKS = """
+import sys
+sys.path.insert(0, %(hooklib)r)
+from hooklib import basehook, runhooks
+
+
+class messages(basehook):
+    kind = 'gate'
+
+    def check(self, log, revdata):
+        msgs = revdata.commitmessagesfor(revdata.revs)
+        return len([m for m in msgs if ': ' in m]) >= 0
+
+
+class changedfiles(basehook):
+    def check(self, log, revdata):
+        if hasattr(revdata, 'changedfiles'):
+            return len(revdata.changedfiles) >= 0
+        return True
+
+
+class noop(basehook):
+    def check(self, log, revdata):
+        return True
+
+
+runhooks(%(phase)r, hooks=[messages, changedfiles, noop],
+         parallel=%(parallel)s)
+"""
+
+
+def percentile(values, p):
+    """Nearest rank percentile of values"""
+    values = sorted(values)
+    rank = max(0, int(round(p / 100.0 * len(values) + 0.5)) - 1)
+    return values[min(rank, len(values) - 1)]
+
+
+def run(args, **kwargs):
+    with open(os.devnull, 'w') as devnull:
+        subprocess.check_call(args, stdout=devnull, **kwargs)
+
+
+def gitrepo(workdir, size, refs, blobsize, blobevery):
+    """Build a bare git repo where size commits wait to be pushed on top
+    of refs/heads/master, return its path and the (old, new) shas"""
+    name = 'git-%d-%d-%d-%d' % (size, refs, blobsize, blobevery)
+    path = os.path.join(workdir, name)
+    shas = os.path.join(path, 'hookbench-shas')
+    if os.path.exists(shas):
+        with open(shas) as f:
+            return path, f.read().split()
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    run(['git', 'init', '-q', '--bare', path])
+    rand = random.Random(size)
+    stream = tempfile.TemporaryFile()
+
+    def write(s):
+        stream.write(s.encode('utf-8') if not isinstance(s, bytes) else s)
+
+    def data(content):
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        write('data %d\n' % len(content))
+        write(content)
+        write('\n')
+
+    def commit(ref, mark, parent, i, files):
+        write('commit %s\nmark :%d\n' % (ref, mark))
+        write('committer bench <bench@example.com> %d +0000\n' % (EPOCH + i))
+        data('component%d: change %d\n\nbody of change %d\n' % (i % 7, i, i))
+        if parent is not None:
+            write('from :%d\n' % parent)
+        for path, content in files:
+            write('M 100644 inline %s\n' % path)
+            data(content)
+
+    commit('refs/heads/master', 1, None, 0, [('README', 'synthetic repo')])
+    for i in range(refs):
+        write('reset refs/tags/bench-%d\nfrom :1\n\n' % i)
+    for i in range(1, size + 1):
+        files = [('src/f%d' % (i % 50), 'content %d\n' % i)]
+        if blobsize and i % blobevery == 0:
+            blob = bytes(bytearray(rand.getrandbits(8)
+                                   for _ in range(blobsize)))
+            files.append(('large/blob%d' % i, blob))
+        commit('refs/heads/incoming', i + 1, i, i, files)
+    write('done\n')
+    stream.seek(0)
+    try:
+        run(['git', 'fast-import', '--quiet', '--done'], stdin=stream,
+            cwd=path)
+    finally:
+        stream.close()
+    git = ['git', '--git-dir', path]
+    old = subprocess.check_output(git + ['rev-parse', 'master']).strip()
+    new = subprocess.check_output(git + ['rev-parse', 'incoming']).strip()
+    # the incoming commits stay in the repo, unreferenced like pushed ones
+    run(git + ['update-ref', '-d', 'refs/heads/incoming'])
+    with open(shas, 'w') as f:
+        f.write('%s %s' % (old.decode('ascii'), new.decode('ascii')))
+    return path, [old.decode('ascii'), new.decode('ascii')]
+
+
+def hgrepo(workdir, size):
+    """Build a hg repo of size + 1 changesets, return its path and the
+    (first, last) nodes of the size last ones"""
+    path = os.path.join(workdir, 'hg-%d' % size)
+    nodes = os.path.join(path, 'hookbench-nodes')
+    if os.path.exists(nodes):
+        with open(nodes) as f:
+            return path, f.read().split()
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    run(['hg', 'init', path])
+    env = dict(os.environ, HGUSER='bench')
+    run(['hg', 'debugbuilddag', '--new-file', '+%d' % (size + 1)],
+        cwd=path, env=env)
+    out = subprocess.check_output(['hg', 'log', '-r', '1', '-r', 'tip', '-T',
+                                   '{node}\n'], cwd=path)
+    with open(nodes, 'w') as f:
+        f.write(out.decode('ascii'))
+    return path, out.decode('ascii').split()
+
+
+def invocation(scm, phase, repo, revs):
+    """Return the argv, stdin, and environment of a hook invocation"""
+    env = dict((k, v) for k, v in os.environ.items()
+               if not k.startswith(('GIT_', 'HG_', 'HOOKLIB_')))
+    if scm == 'hg':
+        env.update(HG_NODE=revs[0], HG_NODE_LAST=revs[1])
+        return [], '', env
+    env['GIT_DIR'] = '.'
+    old, new = revs
+    if phase == 'update':
+        return ['refs/heads/master', old, new], '', env
+    elif phase == 'pre-receive':
+        return [], '%s %s refs/heads/master\n' % (old, new), env
+    return ['refs/heads/master'], '', env
+
+
+def measure(script, argv, stdin, env, cwd):
+    """Run the hook once, return its wall time, profile and peak RSS"""
+    fd, profile = tempfile.mkstemp(prefix='hookbench-')
+    os.close(fd)
+    env = dict(env, HOOKLIB_PROFILE=profile)
+    with tempfile.TemporaryFile() as errors:
+        with open(os.devnull, 'w') as devnull:
+            started = time.time()
+            proc = subprocess.Popen([sys.executable, script] + argv, cwd=cwd,
+                                    env=env, stdin=subprocess.PIPE,
+                                    stdout=devnull, stderr=errors)
+            proc.stdin.write(stdin.encode('utf-8'))
+            proc.stdin.close()
+            # wait4 gives the resource usage of this process alone
+            _, status, usage = os.wait4(proc.pid, 0)
+            wall = time.time() - started
+        proc.returncode = status
+        if status != 0:
+            errors.seek(0)
+            raise RuntimeError('hook failed: %s' %
+                               errors.read().decode('utf-8'))
+    try:
+        with open(profile) as f:
+            measures = [json.loads(line) for line in f]
+    finally:
+        os.unlink(profile)
+    forks = sum(m['forks'] or 0 for m in measures)
+    parse = sum(m['wall'] for m in measures if m['hook'] == 'input parsing')
+    return wall, parse, forks, usage.ru_maxrss
+
+
+def bench(scm, phase, mode, repo, revs, runs, workdir):
+    script = os.path.join(workdir, 'hook-%s-%s.py' % (phase, mode))
+    with open(script, 'w') as f:
+        f.write(HOOKS % {'hooklib': HERE, 'phase': phase,
+                         'parallel': MODES[mode]})
+    argv, stdin, env = invocation(scm, phase, repo, revs)
+    measure(script, argv, stdin, env, repo)  # warm the caches
+    walls, parses, forks, rss = [], [], [], []
+    for i in range(runs):
+        wall, parse, nforks, maxrss = measure(script, argv, stdin, env, repo)
+        walls.append(wall)
+        parses.append(parse)
+        forks.append(nforks)
+        rss.append(maxrss)
+    return {
+        'runs': runs,
+        'p50': percentile(walls, 50),
+        'p90': percentile(walls, 90),
+        'p99': percentile(walls, 99),
+        'parse_p50': percentile(parses, 50),
+        'forks': percentile(forks, 50),
+        'maxrss_kb': max(rss),
+    }
+
+
+def hashg():
+    try:
+        run(['hg', '--version'])
+        return True
+    except (OSError, subprocess.CalledProcessError):
+        return False
+
+
+def runbench(sizes, modes, scms, runs, workdir, refs=100, blobsize=1 << 20,
+             blobevery=1000, report=None):
+    """Run the benchmark, return the results keyed by
+    scm/phase/mode/size"""
+    results = {}
+    for scm in scms:
+        for size in sizes:
+            if scm == 'git':
+                repo, revs = gitrepo(workdir, size, refs, blobsize,
+                                     blobevery)
+            else:
+                repo, revs = hgrepo(workdir, size)
+            for phase in PHASES[scm]:
+                for mode in modes:
+                    key = '%s/%s/%s/%d' % (scm, phase, mode, size)
+                    results[key] = bench(scm, phase, mode, repo, revs, runs,
+                                         workdir)
+                    if report is not None:
+                        report(key, results[key])
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Return the regressions of results compared to baseline"""
+    regressions = []
+    for key, r in sorted(results.items()):
+        b = baseline.get(key)
+        if b is None:
+            continue
+        for field in ('p50', 'p90', 'forks', 'maxrss_kb'):
+            if r[field] > b[field] * (1 + tolerance) and r[field] > 0:
+                regressions.append('%s %s: %s -> %s' % (key, field, b[field],
+                                                       r[field]))
+    return regressions
+
+
+def printresult(key, r):
+    sys.stdout.write('%-40s %8.3f %8.3f %8.3f %8.3f %6d %9d\n' % (
+        key, r['p50'], r['p90'], r['p99'], r['parse_p50'], r['forks'],
+        r['maxrss_kb']))
+    sys.stdout.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default='10,1000',
+                        help='numbers of pushed commits, comma separated')
+    parser.add_argument('--modes', default=','.join(sorted(MODES)),
+                        help='runner modes, comma separated')
+    parser.add_argument('--scms', default='git,hg')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--refs', type=int, default=100,
+                        help='number of refs in the git repos')
+    parser.add_argument('--blob-size', type=int, default=1 << 20,
+                        help='size of the large blobs of the git repos')
+    parser.add_argument('--blob-every', type=int, default=1000,
+                        help='add a large blob every that many commits')
+    parser.add_argument('--workdir',
+                        default=os.path.join(tempfile.gettempdir(),
+                                             'hookbench'))
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--baseline', help='JSON results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    modes = args.modes.split(',')
+    if sys.version_info < (3, 5) and 'async' in modes:
+        modes.remove('async')
+    scms = args.scms.split(',')
+    if 'hg' in scms and not hashg():
+        sys.stderr.write('hg is not installed, skipping the hg repos\n')
+        scms.remove('hg')
+    if not os.path.isdir(args.workdir):
+        os.makedirs(args.workdir)
+
+    sys.stdout.write('%-40s %8s %8s %8s %8s %6s %9s\n' % (
+        'scm/phase/mode/size', 'p50(s)', 'p90(s)', 'p99(s)', 'parse(s)',
+        'forks', 'rss(KB)'))
+    results = runbench([int(s) for s in args.sizes.split(',')], modes, scms,
+                       args.runs, args.workdir, args.refs, args.blob_size,
+                       args.blob_every, report=printresult)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'meta': {'python': platform.python_version(),
+                                'platform': platform.platform(),
+                                'time': time.time()},
+                       'results': results}, f, indent=1, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        for r in regressions:
+            sys.stderr.write('regression: %s\n' % r)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,26 +5,150 @@ that work with multiple source control system (git, svn, hg ...).
 It currently only works for git.
 See https://github.com/charignon/hooklib for examples"""
 import threading
+import os
 import sys
-from Queue import Queue
+import time
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
 from hooklib_input import inputparser
+from hooklib_util import batches, cpucount, stopwatch
 
 
-def runhooks(phase, hooks, parallel=False):
-    if parallel:
-        runner = parallelhookrunner(phase)
-    else:
-        runner = hookrunner(phase)
-    for h in hooks:
-        runner.register(h)
+def runhooks(phase, hooks, parallel=False, max_workers=None, deadline=None,
+             timeoutpolicy='fail', cache=False, timings=None, stream=False,
+             progress=False, detached=False, retries=2):
+    """Run hooks for phase and exit with an error if they don't pass
+
+    parallel can be False to run the hooks one after the other, True (or
+    'thread') to run them in a pool of threads, 'process' to run them
+    in a pool of processes, 'async' to run them on an asyncio event
+    loop (python 3 only, see hooklib_async) and 'scheduled' to run them in
+    threads ordered by their cost and dependencies, learning their cost
+    from the timings file if one is given (see scheduledhookrunner).
+    deadline is the number of seconds after which all the hooks still
+    running are considered timed out, see hookrunner for timeoutpolicy.
+    cache is True to reuse the verdicts of commit hooks stored under GIT_DIR
+    by the previous runs, or the path of the database to use instead, see
+    basecommithook.
+    With stream, the logs are written to stderr while the hooks run instead
+    of once they are all done, and progress shows how many commits the
+    commit hooks checked, see logsink.
+    With detached, post-receive and post-update hooks return at once: their
+    input is spooled under GIT_DIR and the hooks are run in the background
+    by a worker, which tries the failing hooks retries more times, see
+    hooklib_spool."""
+    if detached:
+        import hooklib_spool
+        hooklib_spool.spool(phase, hooks, retries=retries, parallel=parallel,
+                            max_workers=max_workers, deadline=deadline,
+                            timeoutpolicy=timeoutpolicy, cache=cache,
+                            timings=timings, stream=stream,
+                            progress=progress)
+        return
+    runner = makerunner(phase, hooks, parallel, max_workers, deadline,
+                        timeoutpolicy, cache, timings=timings, stream=stream,
+                        progress=progress)
     ret = runner.evaluate()
-    log = runner.log.read()
-    if log:
-        sys.stderr.write("\n".join(log)+"\n")
+    if runner.logsink is not None:
+        runner.logsink.close()
+    else:
+        log = runner.log.read()
+        if log:
+            sys.stderr.write("\n".join(log)+"\n")
+    if os.environ.get('HOOKLIB_PROFILE'):
+        writeprofile(phase, runner, os.environ['HOOKLIB_PROFILE'])
     if not ret:
         sys.exit(1)
 
 
+def makerunner(phase, hooks, parallel=False, max_workers=None, deadline=None,
+               timeoutpolicy='fail', cache=False, revdata=None, timings=None,
+               stream=False, progress=False):
+    """Make the runner of hooks for phase, see runhooks for the arguments.
+    revdata is given by the hooks that do not parse their input, like the
+    in-process mercurial hooks (see hooklib_hg.hghook)"""
+    options = {'deadline': deadline, 'timeoutpolicy': timeoutpolicy,
+               'revdata': revdata}
+    if stream:
+        options['logsink'] = logsink(sys.stderr, progress=progress)
+    if cache:
+        from hooklib_cache import verdictcache
+        options['cache'] = verdictcache(None if cache is True else cache)
+    if parallel == 'process':
+        runner = processhookrunner(phase, max_workers=max_workers, **options)
+    elif parallel == 'scheduled':
+        runner = scheduledhookrunner(phase, max_workers=max_workers,
+                                     timings=timings, **options)
+    elif parallel == 'async':
+        from hooklib_async import asynchookrunner
+        runner = asynchookrunner(phase, max_workers=max_workers, **options)
+    elif parallel:
+        runner = parallelhookrunner(phase, max_workers=max_workers, **options)
+    else:
+        runner = hookrunner(phase, **options)
+    for h in hooks:
+        runner.register(h)
+    return runner
+
+
+def writeprofile(phase, runner, dest):
+    """Report the cost of the input parsing and of each hook of runner
+
+    dest is '1' or 'stderr' to print a table sorted by wall time on stderr,
+    otherwise it is the path of a file to which one JSON object is appended
+    per line for each measure."""
+    results = [runner.parseresult] + runner.results
+    if dest in ('1', 'stderr'):
+        results = sorted(results, key=lambda r: r.wall, reverse=True)
+        lines = ["%-30s %-8s %8s %8s %6s" % ('hook', 'status', 'wall(s)',
+                                             'cpu(s)', 'forks')]
+        for r in results:
+            lines.append("%-30s %-8s %8.3f %8s %6s" % (
+                r.name, r.status, r.wall,
+                '-' if r.cpu is None else '%.3f' % r.cpu,
+                '-' if r.forks is None else r.forks))
+        sys.stderr.write("\n".join(lines)+"\n")
+    else:
+        import json
+        with open(dest, 'a') as f:
+            for r in results:
+                f.write(json.dumps(dict(r.todict(), phase=phase,
+                                        time=runner.started))+"\n")
+
+
+class hookresult(object):
+    """Outcome and cost of running a hook, see hookrunner.results
+
+    The fields of revdata are computed lazily, their cost is accounted to
+    the first hook reading them. cpu and forks are None for hooks that
+    timed out, as they may still be running. forks only counts the
+    processes started by hooklib, see hooklib_util.stopwatch."""
+    def __init__(self, name, blocking=True):
+        self.name = name
+        self.blocking = blocking
+        self.passed = None
+        self.timedout = False
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.forks = 0
+
+    def measured(self, sw):
+        if not self.timedout:
+            self.wall, self.cpu, self.forks = sw.wall, sw.cpu, sw.forks
+
+    @property
+    def status(self):
+        if self.timedout:
+            return 'timeout'
+        return {None: 'not run', True: 'pass', False: 'fail'}[self.passed]
+
+    def todict(self):
+        return {'hook': self.name, 'status': self.status, 'wall': self.wall,
+                'cpu': self.cpu, 'forks': self.forks}
+
+
 class hooklog(object):
     """Collect logs from running hooks"""
     def __init__(self):
@@ -36,6 +160,12 @@ class hooklog(object):
     def read(self):
         return self.msgs
 
+    def flush(self):
+        """Called when the hook writing to the log is done"""
+
+    def progress(self, done, total):
+        """Report that done out of total commits have been checked"""
+
     @staticmethod
     def aggregate(logs):
         msgs = []
@@ -46,22 +176,239 @@ class hooklog(object):
         return ret
 
 
+class logsink(object):
+    """Output shared by the streaming logs of a run, see streamlog
+
+    Messages are written to out as soon as they are logged. A copy of at
+    most maxbytes of them is kept for runner.log, the messages after that
+    are only written. With progress, the hooks iterating over the commits
+    report their progress on a status line."""
+    # seconds between two updates of the status line
+    interval = 0.5
+
+    def __init__(self, out, maxbytes=1 << 20, progress=False):
+        self.out = out
+        self.maxbytes = maxbytes
+        self.size = 0
+        self.dropped = 0
+        self.progress = progress
+        self.status = ''
+        self.updated = 0
+        self.lock = threading.Lock()
+
+    def write(self, msg):
+        """Write msg, return whether it fits in the copy kept in memory"""
+        with self.lock:
+            self.clearstatus()
+            self.out.write(msg + "\n")
+            self.out.flush()
+            if self.size + len(msg) > self.maxbytes:
+                self.dropped += 1
+                return False
+            self.size += len(msg)
+            return True
+
+    def showprogress(self, done, total):
+        now = time.time()
+        if not self.progress or (done < total and
+                                 now - self.updated < self.interval):
+            return
+        with self.lock:
+            self.updated = now
+            self.clearstatus()
+            self.status = "checking commits: %d/%d" % (done, total)
+            self.out.write("\r" + self.status)
+            self.out.flush()
+
+    def clearstatus(self):
+        if self.status:
+            self.out.write("\r%s\r" % (" " * len(self.status)))
+            self.status = ''
+
+    def close(self):
+        with self.lock:
+            self.clearstatus()
+            self.out.flush()
+
+
+class streamlog(hooklog):
+    """hooklog writing the messages to a logsink as they are logged
+
+    A message repeated several times in a row is written once, followed by
+    the number of repeats when another message is logged or the hook is
+    done."""
+    def __init__(self, sink):
+        super(streamlog, self).__init__()
+        self.sink = sink
+        self.last = None
+        self.repeats = 0
+
+    def write(self, msg):
+        if msg == self.last:
+            self.repeats += 1
+            return
+        self.flush()
+        self.last = msg
+        self.emit(msg)
+
+    def emit(self, msg):
+        if self.sink.write(msg):
+            self.msgs.append(msg)
+
+    def flush(self):
+        if self.repeats:
+            self.emit("(previous message repeated %d times)" % self.repeats)
+        self.repeats = 0
+        self.last = None
+
+    def progress(self, done, total):
+        self.sink.showprogress(done, total)
+
+
 class hookrunner(object):
-    def __init__(self, phase=None, phases=None):
+    """Run the registered hooks one after the other
+
+    Hooks can be given a timeout in seconds when they are registered (or
+    with a timeout class attribute), and deadline limits how long the whole
+    run can take. timeoutpolicy decides what a timeout means:
+    - 'fail': the hook fails, the run stops if the hook is blocking
+    - 'warn': the timeout is reported in the log but the hook passes
+    - 'pass': the hook silently passes
+    A hook that times out is told to stop with its canceltoken.
+
+    cache is a hooklib_cache.verdictcache given to the hooks, for commit
+    hooks to reuse their previous verdicts. revdata replaces the parsing of
+    the hook input when it is given. With logsink, the hooks write their
+    logs there as they run, see streamlog.
+
+    After evaluate, results holds a hookresult per registered hook and
+    parseresult the cost of parsing the hook input."""
+    def __init__(self, phase=None, phases=None, deadline=None,
+                 timeoutpolicy='fail', cache=None, revdata=None,
+                 logsink=None):
+        if timeoutpolicy not in ('fail', 'warn', 'pass'):
+            raise ValueError('Invalid timeout policy %s' % timeoutpolicy)
         self.runlist = []
-        if phases is not None:
-            self.revdata = inputparser.fromphases(phases).parse()
+        self.cache = cache
+        self.logsink = logsink
+        self.deadline = deadline
+        self.timeoutpolicy = timeoutpolicy
+        self.parseresult = hookresult('input parsing')
+        sw = stopwatch()
+        with sw:
+            if revdata is not None:
+                self.revdata = revdata
+            elif phases is not None:
+                self.revdata = inputparser.fromphases(phases).parse()
+            else:
+                self.revdata = inputparser.fromphase(phase).parse()
+        self.parseresult.measured(sw)
+        self.parseresult.passed = True
+
+    def register(self, h, blocking=True, timeout=None):
+        if timeout is None:
+            timeout = getattr(h, 'timeout', None)
+        self.runlist.append((h, blocking, timeout))
+
+    def newlog(self):
+        if self.logsink is None:
+            return hooklog()
+        return streamlog(self.logsink)
+
+    def makehook(self, h, token):
+        hook = h()
+        hook.canceltoken = token
+        hook.verdictcache = self.cache
+        return hook
+
+    def timedcheck(self, hook, log, result):
+        """Run hook.check, measuring its cost in result"""
+        sw = stopwatch()
+        try:
+            with sw:
+                return hook.check(log, self.revdata)
+        finally:
+            result.measured(sw)
+
+    def timedout(self, result, elapsed):
+        result.timedout = True
+        result.wall = elapsed or 0.0
+        result.cpu = result.forks = None
+
+    def timelimit(self, timeout, started):
+        """Time at which a hook with timeout started at started times out,
+        None if it can run forever"""
+        limits = []
+        if timeout is not None:
+            limits.append(started + timeout)
+        if self.deadline is not None:
+            limits.append(self.started + self.deadline)
+        return min(limits) if limits else None
+
+    def ontimeout(self, log, h, elapsed):
+        """Apply the timeout policy to h and return whether it passes,
+        elapsed is None if the deadline was reached before h started"""
+        if self.timeoutpolicy == 'pass':
+            return True
+        if elapsed is None:
+            msg = "%s was not run, deadline of %.1fs reached" % \
+                  (h.__name__, self.deadline)
         else:
-            self.revdata = inputparser.fromphase(phase).parse()
+            msg = "%s timed out after %.1fs" % (h.__name__, elapsed)
+        if self.timeoutpolicy == 'warn':
+            log.write("warning: " + msg)
+            return True
+        log.write(msg)
+        return False
 
-    def register(self, h, blocking=True):
-        self.runlist.append((h, blocking))
+    def runone(self, index):
+        h, blocking, timeout = self.runlist[index]
+        result = self.results[index]
+        hook = self.makehook(h, canceltoken(self.canceltoken))
+        started = time.time()
+        limit = self.timelimit(timeout, started)
+        if limit is None:
+            return self.timedcheck(hook, self.log, result)
+        if limit <= started:
+            self.timedout(result, None)
+            return self.ontimeout(self.log, h, None)
+
+        # Run the hook in a thread we can stop waiting for
+        log = self.newlog()
+        hookpass = []
+
+        def check():
+            try:
+                hookpass.append(self.timedcheck(hook, log, result))
+            except Exception as e:
+                hookpass.append(e)
+        t = threading.Thread(target=check)
+        t.daemon = True
+        t.start()
+        t.join(limit - started)
+        # the repeats of the last message are only written on flush
+        log.flush()
+        # already written by streaming logs
+        self.log.msgs.extend(list(log.read()))
+        if not hookpass:
+            hook.canceltoken.cancel()
+            self.timedout(result, time.time() - started)
+            return self.ontimeout(self.log, h, result.wall)
+        if isinstance(hookpass[0], Exception):
+            raise hookpass[0]
+        return hookpass[0]
 
     def evaluate(self):
-        self.log = hooklog()
+        self.log = self.newlog()
+        self.canceltoken = canceltoken()
+        self.started = time.time()
+        self.results = [hookresult(h.__name__, blocking)
+                        for h, blocking, _ in self.runlist]
         success = True
-        for h, blocking in self.runlist:
-            hookpass = h().check(self.log, self.revdata)
+        for i, (h, blocking, timeout) in enumerate(self.runlist):
+            hookpass = self.runone(i)
+            self.log.flush()
+            self.results[i].passed = hookpass
             # Stop evaluating after failure on blocking hook
             if not hookpass and blocking:
                 return False
@@ -72,32 +419,596 @@ class hookrunner(object):
         return success
 
 
+class workerpool(object):
+    """Pool of at most maxworkers threads, reused from task to task
+
+    Threads are started on demand when tasks are submitted. They are daemon
+    threads, a hook that never returns cannot keep the process alive."""
+    def __init__(self, maxworkers=None):
+        if maxworkers is None:
+            maxworkers = cpucount()
+        self.maxworkers = maxworkers
+        self.tasks = Queue()
+        self.threads = []
+
+    def submit(self, fn, *args):
+        if len(self.threads) < self.maxworkers:
+            self.startworker()
+        self.tasks.put((fn, args))
+
+    def startworker(self):
+        t = threading.Thread(target=self.work)
+        t.daemon = True
+        self.threads.append(t)
+        t.start()
+
+    def replace(self):
+        """Start a worker replacing one stuck in a task that timed out, for
+        the tasks queued behind it to start"""
+        self.startworker()
+
+    def work(self):
+        while True:
+            fn, args = self.tasks.get()
+            if fn is None:
+                return
+            fn(*args)
+
+    def runall(self, fn, items, chunksize=1):
+        """Return [fn(item) for item in items], computed by the calling
+        thread with the help of the workers of the pool
+
+        The items are handed out by chunks of chunksize. As the calling
+        thread takes its share, a task of the pool can call runall without
+        waiting for workers busy with other tasks."""
+        chunks = Queue()
+        for start in range(0, len(items), chunksize):
+            chunks.put(start)
+        results = [None] * len(items)
+        errors = []
+        left = [chunks.qsize()]
+        done = threading.Condition()
+
+        def work():
+            while True:
+                try:
+                    start = chunks.get_nowait()
+                except Empty:
+                    return
+                try:
+                    for i in range(start, min(start + chunksize, len(items))):
+                        results[i] = fn(items[i])
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    with done:
+                        left[0] -= 1
+                        done.notify_all()
+        for i in range(min(self.maxworkers, left[0]) - 1):
+            self.submit(work)
+        work()
+        with done:
+            while left[0]:
+                done.wait()
+        if errors:
+            raise errors[0]
+        return results
+
+    def shutdown(self):
+        for t in self.threads:
+            self.tasks.put((None, None))
+        self.threads = []
+
+
 class parallelhookrunner(hookrunner):
-    def evaluateone(self, hook):
-        log = hooklog()
-        hookpass = hook().check(log, self.revdata)
-        self.resultqueue.put((hookpass, log))
+    def __init__(self, phase=None, phases=None, max_workers=None, **kwargs):
+        super(parallelhookrunner, self).__init__(phase, phases, **kwargs)
+        self.pool = workerpool(max_workers)
+
+    def makehook(self, h, token):
+        hook = super(parallelhookrunner, self).makehook(h, token)
+        hook.pool = self.pool
+        return hook
+
+    def runcheck(self, index, log, token):
+        hook = self.makehook(self.runlist[index][0], token)
+        return self.timedcheck(hook, log, self.results[index])
+
+    def evaluateone(self, index, hook, token, starts, resultqueue):
+        if token.cancelled():
+            return
+        starts[index] = time.time()
+        log = self.newlog()
+        try:
+            hookpass = self.runcheck(index, log, token)
+        except Exception as e:
+            # The result must be reported even if the hook crashes, or
+            # evaluate would wait for it forever
+            log.write("%s raised %r" % (hook.__name__, e))
+            hookpass = False
+        log.flush()
+        resultqueue.put((index, hookpass, log))
+
+    def nexttimeout(self, pending, starts):
+        """Return the time at which the next pending hook times out, or at
+        which to look again at the hooks not started yet"""
+        limits = []
+        now = time.time()
+        for i in pending:
+            # a hook that has not started yet can start any time, it cannot
+            # time out before its timeout from now
+            limits.append(self.timelimit(self.runlist[i][2],
+                                         starts.get(i, now)))
+        limits = [l for l in limits if l is not None]
+        return min(limits) if limits else None
+
+    def timeouts(self, pending, starts):
+        """Collect the results of the pending hooks that timed out"""
+        now = time.time()
+        for i in list(pending):
+            started = starts.get(i)
+            limit = self.timelimit(self.runlist[i][2],
+                                   started if started is not None else now)
+            if limit is not None and limit <= now:
+                self.tokens[i].cancel()
+                if started is not None:
+                    self.abandon(i)
+                log = self.newlog()
+                elapsed = now - started if started is not None else None
+                self.timedout(self.results[i], elapsed)
+                hookpass = self.ontimeout(log, self.runlist[i][0], elapsed)
+                yield i, hookpass, log
+
+    def abandon(self, index):
+        """Give up on the started hook index that timed out, it may never
+        return: do not let it hold its worker"""
+        self.pool.replace()
 
     def evaluate(self):
-        threads = []
-        self.resultqueue = Queue()
-        for h, _ in self.runlist:
-            t = threading.Thread(target=self.evaluateone, args=(h, ))
-            threads.append(t)
-            t.start()
-        for t in threads:
-            t.join()
-        res, logs = [], []
+        try:
+            return self.evaluatepool()
+        finally:
+            # the hooks still running finish on their own, the threads
+            # exit once they are done
+            self.pool.shutdown()
+
+    def schedule(self):
+        """Compute the hooks that must pass before each hook runs, none by
+        default"""
+        self.requires = [set() for h in self.runlist]
+
+    def startready(self, pending, starts, resultqueue):
+        """Submit the pending hooks that can start now to the pool"""
+        for i in sorted(self.waiting):
+            self.pool.submit(self.evaluateone, i, self.runlist[i][0],
+                             self.tokens[i], starts, resultqueue)
+        self.waiting.clear()
+
+    def finished(self, index, hookpass, pending):
+        """Called with the result of each hook, before the run stops on a
+        blocking failure"""
+
+    def evaluatepool(self):
+        self.schedule()
+        self.canceltoken = canceltoken()
+        self.tokens = [canceltoken(self.canceltoken) for h in self.runlist]
+        self.started = time.time()
+        self.results = [hookresult(h.__name__, blocking)
+                        for h, blocking, _ in self.runlist]
+        self.waiting = dict((i, set(r)) for i, r in enumerate(self.requires))
+        resultqueue = Queue()
+        starts = {}
+        pending = set(range(len(self.runlist)))
+        success = True
+        logs = []
+        while pending:
+            self.startready(pending, starts, resultqueue)
+            limit = self.nexttimeout(pending, starts)
+            try:
+                if limit is None:
+                    results = [resultqueue.get()]
+                else:
+                    results = [resultqueue.get(timeout=max(0, limit -
+                                                           time.time()))]
+            except Empty:
+                results = list(self.timeouts(pending, starts))
+            for index, hookpass, log in results:
+                if index not in pending:
+                    # Finished after having timed out
+                    continue
+                pending.discard(index)
+                logs.append((index, log))
+                self.results[index].passed = hookpass
+                self.finished(index, hookpass, pending)
+                if not hookpass:
+                    success = False
+                    # Stop evaluating after failure on blocking hook, the
+                    # hooks still running are told to stop and their result
+                    # ignored
+                    if self.runlist[index][1]:
+                        self.canceltoken.cancel()
+                        pending.clear()
+                        break
+        self.log = hooklog.aggregate(l for _, l in sorted(logs))
+        return success
+
+
+def checkinprocess(h, revdata, cache=None):
+    """Entry point of the worker processes of processhookrunner"""
+    log = hooklog()
+    sw = stopwatch()
+    hook = h()
+    hook.verdictcache = cache
+    try:
+        with sw:
+            hookpass = hook.check(log, revdata)
+    finally:
+        # revdata is the copy unpickled for this call, with its own git
+        # processes
+        if hasattr(revdata, 'close'):
+            revdata.close()
+    return hookpass, log.read(), sw
+
+
+def checkcommits(h, revdata, revs):
+    """Entry point of the worker processes checking revs with the commit
+    hook h, see basecommithook.checkmany"""
+    hook = h()
+    try:
+        prefetch = getattr(revdata, 'prefetch', None)
+        if prefetch is not None:
+            prefetch(revs)
+        return [hook.checkone(revdata, rev) for rev in revs]
+    finally:
+        if hasattr(revdata, 'close'):
+            revdata.close()
+
+
+class processhookrunner(parallelhookrunner):
+    """Run the hooks in a pool of processes, for CPU bound hooks
+
+    The hook classes and revdata are pickled to be sent to the workers,
+    hooks must be defined at the top level of a module. The logs of the
+    workers are merged back in the order the hooks were registered.
+    Commit hooks run in this process and spread their commits over the
+    workers, the verdict cache stays here."""
+    def makehook(self, h, token):
+        hook = super(processhookrunner, self).makehook(h, token)
+        hook.processes = self.processes
+        return hook
+
+    def runcheck(self, index, log, token):
+        if issubclass(self.runlist[index][0], basecommithook):
+            return super(processhookrunner, self).runcheck(index, log, token)
+        hookpass, msgs, sw = self.processes.apply(
+            checkinprocess, (self.runlist[index][0], self.revdata,
+                             self.cache))
+        for m in msgs:
+            log.write(m)
+        self.results[index].measured(sw)
+        return hookpass
+
+    def abandon(self, index):
+        # its process is stuck too: the hooks after it run in new processes,
+        # the others still running in the old ones finish there
+        import multiprocessing
+        self.retired.append(self.processes)
+        self.processes = multiprocessing.Pool(self.pool.maxworkers)
+        super(processhookrunner, self).abandon(index)
+
+    def evaluate(self):
+        import multiprocessing
+        self.processes = multiprocessing.Pool(self.pool.maxworkers)
+        self.retired = []
+        try:
+            return super(processhookrunner, self).evaluate()
+        finally:
+            for processes in self.retired + [self.processes]:
+                processes.terminate()
+
+
+class hooktimings(object):
+    """Wall time of the hooks in the previous runs, stored as JSON at path
+
+    The estimate of a hook is a moving average of its measures, recent runs
+    weigh more."""
+    def __init__(self, path):
+        import json
+        self.path = path
+        try:
+            with open(path) as f:
+                self.walls = json.load(f)
+        except (IOError, ValueError):
+            self.walls = {}
+
+    @staticmethod
+    def key(h):
+        return '%s.%s' % (h.__module__, h.__name__)
+
+    def estimate(self, h):
+        return self.walls.get(hooktimings.key(h))
 
-        for h in range(len(self.runlist)):
-            r, l = self.resultqueue.get()
-            res.append(r)
-            logs.append(l)
+    def record(self, runner):
+        import json
+        for (h, _, _), r in zip(runner.runlist, runner.results):
+            if r.status not in ('pass', 'fail'):
+                continue
+            old = self.walls.get(hooktimings.key(h))
+            self.walls[hooktimings.key(h)] = r.wall if old is None \
+                else 0.7 * old + 0.3 * r.wall
+        tmp = '%s.%d' % (self.path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self.walls, f)
+        os.rename(tmp, self.path)
 
-        self.log = hooklog.aggregate(logs)
-        return all(res)
+
+class scheduledhookrunner(parallelhookrunner):
+    """Run the hooks in an order driven by their cost and dependencies
+
+    Hooks can declare with class attributes:
+    - requires: the hooks that must pass before they run, a hook is not run
+      when one of its requirements does not pass
+    - cost: an estimate of their running time in seconds
+    - kind: 'gate' for cheap checks rejecting bad input early or 'scan' for
+      expensive ones, by default hooks whose cost is below gatecost are
+      gates.
+    The blocking gates run first, cheapest first, and the scans only start
+    once they all passed: most rejections happen before any expensive hook
+    starts. Hooks that do not depend on each other run in parallel.
+    With timings (a path), the costs measured in the previous runs replace
+    the declared ones and the measures of the run are recorded."""
+    gatecost = 0.1
+
+    def __init__(self, phase=None, phases=None, max_workers=None,
+                 timings=None, **kwargs):
+        super(scheduledhookrunner, self).__init__(phase, phases, max_workers,
+                                                  **kwargs)
+        self.timings = hooktimings(timings) if timings else None
+
+    def estimate(self, h):
+        if self.timings is not None:
+            measured = self.timings.estimate(h)
+            if measured is not None:
+                return measured
+        return getattr(h, 'cost', None)
+
+    def schedule(self):
+        """Compute the requirements, dependents, barrier (the hooks running
+        before the scans) and priority of each registered hook"""
+        indices = dict((h, i) for i, (h, _, _) in enumerate(self.runlist))
+        n = len(self.runlist)
+        self.requires = []
+        self.dependents = [[] for i in range(n)]
+        for i, (h, _, _) in enumerate(self.runlist):
+            reqs = set()
+            for r in getattr(h, 'requires', None) or []:
+                if r not in indices:
+                    raise ValueError('%s requires %s which is not registered'
+                                     % (h.__name__, r.__name__))
+                reqs.add(indices[r])
+                self.dependents[indices[r]].append(i)
+            self.requires.append(reqs)
+        self.checkcycles()
+        costs = [self.estimate(h) for h, _, _ in self.runlist]
+        self.priority = []
+        gates = []
+        for i, (h, blocking, _) in enumerate(self.runlist):
+            kind = getattr(h, 'kind', None)
+            if kind is None:
+                cheap = costs[i] is not None and costs[i] < self.gatecost
+                kind = 'gate' if cheap else 'scan'
+            if kind == 'gate' and blocking:
+                gates.append(i)
+            unknown = costs[i] is None
+            self.priority.append((kind != 'gate', not blocking, unknown,
+                                  costs[i] or 0, i))
+        # the requirements of the gates run before the scans too
+        self.barrier = set()
+        while gates:
+            i = gates.pop()
+            if i not in self.barrier:
+                self.barrier.add(i)
+                gates.extend(self.requires[i])
+
+    def checkcycles(self):
+        done = set()
+        for start in range(len(self.runlist)):
+            path, stack = set(), [(start, False)]
+            while stack:
+                i, leaving = stack.pop()
+                if leaving:
+                    path.discard(i)
+                    done.add(i)
+                    continue
+                if i in path:
+                    raise ValueError('%s requires itself' %
+                                     self.runlist[i][0].__name__)
+                if i in done:
+                    continue
+                path.add(i)
+                stack.append((i, True))
+                stack.extend((r, False) for r in self.requires[i])
+
+    def skip(self, index, pending):
+        """Do not run the hooks depending on index"""
+        for d in self.dependents[index]:
+            if d in pending:
+                pending.discard(d)
+                self.waiting.pop(d, None)
+                self.skip(d, pending)
+
+    def startready(self, pending, starts, resultqueue):
+        # start the ready hooks, by priority, as long as workers are free
+        ready = sorted(self.priority[i] for i, reqs in self.waiting.items()
+                       if not reqs)
+        gated = self.barrier & pending
+        for priority in ready:
+            i = priority[-1]
+            if len(self.running) >= self.pool.maxworkers:
+                break
+            if gated and i not in self.barrier:
+                continue
+            del self.waiting[i]
+            self.running.add(i)
+            self.pool.submit(self.evaluateone, i, self.runlist[i][0],
+                             self.tokens[i], starts, resultqueue)
+
+    def finished(self, index, hookpass, pending):
+        self.running.discard(index)
+        self.waiting.pop(index, None)
+        if hookpass:
+            for d in self.dependents[index]:
+                if d in self.waiting:
+                    self.waiting[d].discard(index)
+        else:
+            self.skip(index, pending)
+
+    def evaluatepool(self):
+        self.running = set()
+        success = super(scheduledhookrunner, self).evaluatepool()
+        if self.timings is not None:
+            self.timings.record(self)
+        return success
+
+
+class canceltoken(object):
+    """Tell running hooks that their result is not needed anymore
+
+    A token is cancelled when its parent is, this lets the runners cancel
+    one hook or the whole run."""
+    def __init__(self, parent=None):
+        self.event = threading.Event()
+        self.parent = parent
+
+    def cancel(self):
+        self.event.set()
+
+    def cancelled(self):
+        if self.parent is not None and self.parent.cancelled():
+            return True
+        return self.event.is_set()
 
 
 class basehook(object):
-    """A basehook to be subclassed by user implemented hooks"""
-    pass
+    """A basehook to be subclassed by user implemented hooks
+
+    When hooks run in parallel, a failing blocking hook ends the run while
+    the others are still running. Long running hooks should check
+    self.cancelled() regularly and return early when it is True, their
+    result is ignored anyway.
+    Set the timeout class attribute to limit how long the hook can run
+    for, in seconds. See scheduledhookrunner for requires, cost and kind."""
+    canceltoken = None
+    timeout = None
+    requires = None
+    cost = None
+    kind = None
+
+    def cancelled(self):
+        return self.canceltoken is not None and self.canceltoken.cancelled()
+
+
+class basecommithook(basehook):
+    """A hook checking each new commit on its own
+
+    Subclasses implement checkcommit(log, revdata, rev) instead of check,
+    it is called for each rev of revdata.revs and returns whether the commit
+    passes. As the verdict only depends on the commit, it is stored in the
+    verdict cache when the runner has one (see runhooks): the commits
+    checked by a previous run are not checked again, their failures are
+    replayed from the cache. Set the version class attribute and bump it
+    when the hook changes, by default the source of the class is used to
+    tell the versions apart.
+    When the hooks run in parallel, the commits are checked by all the
+    workers of the runner: checkcommit is called from several threads at
+    once unless the threadsafe class attribute is False. The data of the
+    commits is prefetched in batches with revdata.prefetch beforehand and
+    the logs of the commits are written in the order of revdata.revs, the
+    time and processes of the workers are added to the cost of the hook.
+    With processhookrunner, the commits are checked by its processes
+    instead, each of them prefetching the data of its own commits."""
+    version = None
+    verdictcache = None
+    pool = None
+    processes = None
+    threadsafe = True
+
+    def checkcommit(self, log, revdata, rev):
+        raise NotImplementedError()
+
+    def checkone(self, revdata, rev):
+        """Return whether rev passes and its log, None when cancelled"""
+        if self.cancelled():
+            return None
+        commitlog = hooklog()
+        passed = self.checkcommit(commitlog, revdata, rev)
+        return passed, commitlog.read()
+
+    def checkmany(self, revdata, revs):
+        """Return a dict of rev => (passed, msgs) for revs"""
+        if self.processes is not None and len(revs) > 1:
+            # revdata is pickled with each chunk, one per process
+            size = -(-len(revs) // self.pool.maxworkers)
+            tasks = [self.processes.apply_async(
+                checkcommits, (self.__class__, revdata, chunk))
+                for chunk in batches(revs, size)]
+            verdicts = []
+            for task in tasks:
+                if self.cancelled():
+                    break
+                verdicts.extend(task.get())
+            return dict(zip(revs, verdicts))
+        prefetch = getattr(revdata, 'prefetch', None)
+        if revs and prefetch is not None:
+            prefetch(revs)
+        if self.pool is None or not self.threadsafe or len(revs) < 2:
+            verdicts = [self.checkone(revdata, rev) for rev in revs]
+        else:
+            # the stopwatch of the hook only sees its own thread, the
+            # commits checked by the workers are measured on their own
+            owner = stopwatch.current()
+            caller = threading.current_thread()
+            lock = threading.Lock()
+
+            def checkmeasured(rev):
+                if owner is None or threading.current_thread() is caller:
+                    return self.checkone(revdata, rev)
+                sw = stopwatch()
+                try:
+                    with sw:
+                        return self.checkone(revdata, rev)
+                finally:
+                    with lock:
+                        owner.add(sw)
+            chunksize = max(1, len(revs) // (self.pool.maxworkers * 4))
+            verdicts = self.pool.runall(checkmeasured, revs, chunksize)
+        return dict((rev, v) for rev, v in zip(revs, verdicts)
+                    if v is not None)
+
+    def check(self, log, revdata):
+        cache = self.verdictcache
+        success = True
+        done, total = 0, len(revdata.revs)
+        for revs in batches(revdata.revs, 500):
+            if self.cancelled():
+                break
+            verdicts = {} if cache is None else cache.getmany(self, revs)
+            missing = [rev for rev in revs if rev not in verdicts]
+            checked = self.checkmany(revdata, missing)
+            verdicts.update(checked)
+            for rev in revs:
+                if rev not in verdicts:
+                    # cancelled
+                    break
+                done += 1
+                passed, msgs = verdicts[rev]
+                if cache is not None and rev in checked:
+                    cache.put(self, rev, passed, msgs)
+                for m in msgs:
+                    log.write(m)
+                if not passed:
+                    success = False
+                log.progress(done, total)
+        if cache is not None:
+            cache.flush()
+        return success
@@ -0,0 +1,125 @@
+"""asyncio hook runner, needs python 3.5 or later
+
+Selected with runhooks(..., parallel='async'). Hooks whose check method is
+a coroutine function run concurrently on a single event loop, the other
+hooks are run in a pool of threads by the loop's executor. The resolvers
+offer coroutine versions of their methods, prefixed with an 'a' (like
+revdata.acommitmessagefor), that do not block the loop: git reads go
+through the resolver's memo and object backend in the loop's executor,
+mercurial commands run with asyncio.create_subprocess_exec."""
+import asyncio
+import concurrent.futures
+import time
+from hooklib import hookrunner, hooklog, hookresult, canceltoken
+from hooklib_util import countfork, cpucount, tostr
+
+
+async def readcmd(args):
+    """Coroutine version of hooklib_util.readcmd"""
+    countfork()
+    proc = await asyncio.create_subprocess_exec(
+        *args, stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE)
+    out, _ = await proc.communicate()
+    return proc.returncode, tostr(out)
+
+
+async def gitcommitmessagefor(revdata, rev):
+    """The message of rev read by revdata.commitmessagefor in a thread, the
+    object backend reads in process or through its long running cat-file,
+    no git is started per rev"""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(None, revdata.commitmessagefor, rev)
+
+
+async def hgcommitmessagefor(rev):
+    return (await readcmd(['hg', 'log', '-r', rev, '-T', '{desc}']))[1]
+
+
+class asynchookrunner(hookrunner):
+    """Run coroutine hooks on an event loop and the others in threads
+
+    The cost of coroutine hooks is measured in wall time only: they share
+    the thread of the event loop, their CPU time and forks cannot be told
+    apart. See hookrunner for blocking hooks and timeouts."""
+    def __init__(self, phase=None, phases=None, max_workers=None, **kwargs):
+        super(asynchookrunner, self).__init__(phase, phases, **kwargs)
+        self.maxworkers = max_workers or cpucount()
+
+    async def acheck(self, hook, log, result):
+        if asyncio.iscoroutinefunction(hook.check):
+            started = time.time()
+            try:
+                return await hook.check(log, self.revdata)
+            finally:
+                if not result.timedout:
+                    result.wall = time.time() - started
+                    result.cpu = result.forks = None
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, self.timedcheck,
+                                          hook, log, result)
+
+    async def arunone(self, index):
+        h, blocking, timeout = self.runlist[index]
+        result = self.results[index]
+        hook = self.makehook(h, canceltoken(self.canceltoken))
+        log = self.newlog()
+        started = time.time()
+        limit = self.timelimit(timeout, started)
+        if limit is not None and limit <= started:
+            self.timedout(result, None)
+            return self.ontimeout(log, h, None), log
+        try:
+            hookpass = await asyncio.wait_for(
+                self.acheck(hook, log, result),
+                None if limit is None else limit - started)
+        except asyncio.TimeoutError:
+            hook.canceltoken.cancel()
+            self.timedout(result, time.time() - started)
+            hookpass = self.ontimeout(log, h, result.wall)
+        except Exception as e:
+            log.write("%s raised %r" % (h.__name__, e))
+            hookpass = False
+        log.flush()
+        return hookpass, log
+
+    async def aevaluate(self):
+        self.canceltoken = canceltoken()
+        self.started = time.time()
+        self.results = [hookresult(h.__name__, blocking)
+                        for h, blocking, _ in self.runlist]
+        tasks = dict((asyncio.ensure_future(self.arunone(i)), i)
+                     for i in range(len(self.runlist)))
+        pending = set(tasks)
+        success = True
+        logs = []
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED)
+            for t in done:
+                index = tasks[t]
+                hookpass, log = t.result()
+                logs.append((index, log))
+                self.results[index].passed = hookpass
+                if not hookpass:
+                    success = False
+                    # Stop evaluating after failure on blocking hook
+                    if self.runlist[index][1]:
+                        self.canceltoken.cancel()
+                        for p in pending:
+                            p.cancel()
+                        await asyncio.gather(*pending, return_exceptions=True)
+                        pending = set()
+                        break
+        self.log = hooklog.aggregate(l for _, l in sorted(logs,
+                                                          key=lambda x: x[0]))
+        return success
+
+    def evaluate(self):
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.maxworkers)
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.aevaluate())
+        finally:
+            loop.close()
+            self.executor.shutdown(wait=False)
@@ -0,0 +1,107 @@
+"""Persistent cache of the verdicts of commit hooks
+
+The verdict of a basecommithook on a commit only depends on the commit, it
+can be reused when the same commits are pushed again: force-push retries,
+rebased branches re-pushed or mirrors pushing to several repos. Verdicts
+are stored in a sqlite database keyed by hook, hook fingerprint and commit
+sha. Failures are stored with their log messages, to replay them."""
+import hashlib
+import inspect
+import json
+import os
+import sqlite3
+import threading
+import time
+from hooklib_util import readcmd, tobytes
+
+
+def fingerprint(hookclass):
+    """Identify the version of a hook, the version class attribute if it
+    is set and a hash of the source of the class otherwise"""
+    if getattr(hookclass, 'version', None) is not None:
+        return 'v%s' % hookclass.version
+    try:
+        source = inspect.getsource(hookclass)
+    except (IOError, TypeError):
+        return ''
+    return hashlib.sha1(tobytes(source)).hexdigest()
+
+
+class verdictcache(object):
+    """Verdicts of commit hooks, stored in a sqlite database at path
+
+    At most maxentries verdicts are kept, the least recently used ones are
+    evicted first. Writes are only committed to the database by flush."""
+    def __init__(self, path=None, maxentries=100000):
+        if path is None:
+            path = verdictcache.defaultpath()
+        self.path = path
+        self.maxentries = maxentries
+        self.fingerprints = {}
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.db.execute('PRAGMA synchronous=OFF')
+        self.db.execute('CREATE TABLE IF NOT EXISTS verdicts ('
+                        'hook TEXT, fingerprint TEXT, sha TEXT, '
+                        'passed INTEGER, log TEXT, used REAL, '
+                        'PRIMARY KEY (hook, fingerprint, sha))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS verdictsused '
+                        'ON verdicts (used)')
+
+    @staticmethod
+    def defaultpath():
+        gitdir = os.environ.get('GIT_DIR')
+        if gitdir is None:
+            gitdir = readcmd(['git', 'rev-parse', '--git-dir']).strip()
+        return os.path.join(gitdir, 'hooklib-verdicts.sqlite')
+
+    def __reduce__(self):
+        # Sent to the workers of processhookrunner, that open their own
+        # connection
+        return (verdictcache, (self.path, self.maxentries))
+
+    def key(self, hook):
+        cls = type(hook)
+        if cls not in self.fingerprints:
+            self.fingerprints[cls] = fingerprint(cls)
+        return '%s.%s' % (cls.__module__, cls.__name__), self.fingerprints[cls]
+
+    def getmany(self, hook, shas):
+        """Return a dict of sha => (passed, log messages) for the shas that
+        have a verdict"""
+        name, fp = self.key(hook)
+        res = {}
+        with self.lock:
+            # sqlite limits the number of parameters of a query
+            for i in range(0, len(shas), 500):
+                chunk = shas[i:i + 500]
+                rows = self.db.execute(
+                    'SELECT sha, passed, log FROM verdicts WHERE hook = ? AND '
+                    'fingerprint = ? AND sha IN (%s)' %
+                    ','.join('?' * len(chunk)), [name, fp] + list(chunk))
+                for sha, passed, log in rows:
+                    res[sha] = bool(passed), json.loads(log)
+            self.db.executemany(
+                'UPDATE verdicts SET used = ? WHERE hook = ? AND '
+                'fingerprint = ? AND sha = ?',
+                [(time.time(), name, fp, sha) for sha in res])
+        return res
+
+    def put(self, hook, sha, passed, msgs):
+        name, fp = self.key(hook)
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO verdicts VALUES '
+                            '(?, ?, ?, ?, ?, ?)',
+                            (name, fp, sha, int(passed), json.dumps(msgs),
+                             time.time()))
+
+    def flush(self):
+        """Evict the verdicts over maxentries and commit the changes"""
+        with self.lock:
+            count = self.db.execute('SELECT COUNT(*) FROM verdicts')\
+                           .fetchone()[0]
+            if count > self.maxentries:
+                self.db.execute('DELETE FROM verdicts WHERE rowid IN ('
+                                'SELECT rowid FROM verdicts ORDER BY used '
+                                'LIMIT ?)', (count - self.maxentries, ))
+            self.db.commit()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""Hook forwarding its invocation to a hooklib server, see hooklib_server
+
+Install it (or a symlink to it) under the name of the hook, like
+.git/hooks/pre-receive: the phase is the name the script is run as. It
+only imports what it needs to talk to the server, the hooks themselves run
+in the server that has them loaded already. The server is found at the
+path in HOOKLIB_SOCKET, /tmp/hooklib-<uid>/hooklib.sock by default. The
+client only talks to a server run by its own user, root or the user whose
+uid is in HOOKLIB_SERVER_UID: anyone can listen where the client looks
+for the server and accept every push."""
+import json
+import os
+import socket
+import struct
+import sys
+
+# The environment variables hooks get their input from
+FORWARDED = ('GIT_', 'HG_', 'HOOKLIB_')
+# Not exposed by the socket module of python 2
+PEERCRED = getattr(socket, 'SO_PEERCRED',
+                   17 if sys.platform.startswith('linux') else None)
+
+
+def socketdir():
+    """The directory of the default socket, private to the user"""
+    return '/tmp/hooklib-%d' % os.getuid()
+
+
+def socketpath():
+    return os.environ.get('HOOKLIB_SOCKET',
+                          os.path.join(socketdir(), 'hooklib.sock'))
+
+
+def serveruids():
+    """The users trusted to run the server"""
+    uids = set([os.getuid(), 0])
+    if os.environ.get('HOOKLIB_SERVER_UID'):
+        uids.add(int(os.environ['HOOKLIB_SERVER_UID']))
+    return uids
+
+
+def checkserver(sock, path):
+    """Raise socket.error unless the server connected to on sock is run by
+    a trusted user"""
+    if PEERCRED is not None:
+        creds = sock.getsockopt(socket.SOL_SOCKET, PEERCRED,
+                                struct.calcsize('3i'))
+        uid = struct.unpack('3i', creds)[1]
+    else:
+        uid = os.stat(path).st_uid
+    if uid not in serveruids():
+        raise socket.error('the server at %s is run by uid %d' % (path, uid))
+
+
+def sendmsg(sock, obj):
+    data = json.dumps(obj).encode('utf-8')
+    sock.sendall(struct.pack('>I', len(data)) + data)
+
+
+def recvexactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 65536))
+        if not chunk:
+            raise EOFError('connection closed by the hooklib server')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def recvmsg(sock):
+    size = struct.unpack('>I', recvexactly(sock, 4))[0]
+    return json.loads(recvexactly(sock, size).decode('utf-8'))
+
+
+def main():
+    if sys.stdin is None or sys.stdin.isatty():
+        stdin = ''
+    else:
+        stdin = sys.stdin.read()
+    if isinstance(stdin, bytes):
+        stdin = stdin.decode('utf-8', 'replace')
+    request = {
+        'argv': sys.argv,
+        'env': dict((k, v) for k, v in os.environ.items()
+                    if k.startswith(FORWARDED)),
+        'cwd': os.getcwd(),
+        'stdin': stdin,
+    }
+    path = socketpath()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        checkserver(sock, path)
+        sendmsg(sock, request)
+        reply = recvmsg(sock)
+    except (socket.error, EOFError) as e:
+        # Fail closed, the hooks could not check anything
+        sys.stderr.write("hooklib server unavailable: %s\n" % e)
+        return 1
+    finally:
+        sock.close()
+    sys.stderr.write(reply['output'])
+    return reply['status']
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -3,52 +3,830 @@
 Their implementation match what is described at
 https://git-scm.com/docs/githooks"""
 
-from mercurial import util
+from hooklib_util import cachedproperty, popen, readcmd, tobytes, tostr
+from hooklib_util import batches, lazysubprocess, memoized
 import hooklib_input
+import binascii
+import collections
+import threading
 import sys
 import os
 
 
+def isfullsha(rev):
+    return len(rev) == 40 and all(c in '0123456789abcdef' for c in rev)
+
+
+def iszero(sha):
+    """Whether sha is the null sha git uses for created and deleted refs"""
+    return sha.strip('0') == ''
+
+
+def tobinary(sha):
+    """The 20 bytes of a hex sha"""
+    return binascii.unhexlify(sha)
+
+
+def tohex(node):
+    return tostr(binascii.hexlify(node))
+
+
+class shalist(object):
+    """List of hex shas stored as a contiguous buffer of binary shas
+
+    A sha takes 20 bytes instead of the ~90 bytes of a str and a list
+    slot. A shalist compares equal to the list of its hex shas, the shas
+    are decoded when they are read. Membership tests use a set of the
+    binary shas built by the first one."""
+    __slots__ = ('data', 'width', 'index')
+
+    def __init__(self, shas=(), data=b'', width=20):
+        self.data = bytearray(data)
+        self.width = width
+        self.index = None
+        for sha in shas:
+            self.append(sha)
+
+    def append(self, sha):
+        self.appendbinary(tobinary(sha))
+
+    def appendbinary(self, node):
+        if not self.data:
+            # sha256 repos have 32 bytes shas
+            self.width = len(node)
+        elif len(node) != self.width:
+            raise ValueError('%s is not a sha of %d bytes' %
+                             (tohex(node), self.width))
+        self.data += node
+        if self.index is not None:
+            self.index.add(bytes(node))
+
+    def binary(self, i):
+        return bytes(self.data[i * self.width:(i + 1) * self.width])
+
+    def __len__(self):
+        return len(self.data) // self.width
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            nodes = [self.binary(j) for j in range(*i.indices(len(self)))]
+            return shalist(data=b''.join(nodes), width=self.width)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('shalist index out of range')
+        return tohex(self.binary(i))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield tohex(self.binary(i))
+
+    def __contains__(self, sha):
+        try:
+            node = tobinary(sha)
+        except (TypeError, ValueError):
+            return False
+        if self.index is None:
+            self.index = set(self.binary(i) for i in range(len(self)))
+        return node in self.index
+
+    def __eq__(self, other):
+        if isinstance(other, shalist):
+            return self.data == other.data
+        if isinstance(other, (list, tuple)):
+            return len(self) == len(other) and \
+                all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'shalist(%r)' % list(self)
+
+    def __reduce__(self):
+        return (shalist, ((), bytes(self.data), self.width))
+
+
+class shasrecord(object):
+    """Record of a line of hook input, behaving like the tuple of its
+    fields. The shas are kept in binary and decoded on access"""
+    __slots__ = ()
+
+    def astuple(self):
+        raise NotImplementedError()
+
+    def __iter__(self):
+        return iter(self.astuple())
+
+    def __len__(self):
+        return len(self.astuple())
+
+    def __getitem__(self, i):
+        return self.astuple()[i]
+
+    def __eq__(self, other):
+        if isinstance(other, (shasrecord, tuple)):
+            return self.astuple() == tuple(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    def __hash__(self):
+        return hash(self.astuple())
+
+    def __repr__(self):
+        return '%s%r' % (self.__class__.__name__, self.astuple())
+
+    def __reduce__(self):
+        return (self.__class__, self.astuple())
+
+
+class refupdate(shasrecord):
+    """(old, new, ref) line of the pre-receive and post-receive input"""
+    __slots__ = ('_old', '_new', 'ref')
+
+    def __init__(self, old, new, ref):
+        self._old = tobinary(old)
+        self._new = tobinary(new)
+        self.ref = ref
+
+    @property
+    def old(self):
+        return tohex(self._old)
+
+    @property
+    def new(self):
+        return tohex(self._new)
+
+    def astuple(self):
+        return (self.old, self.new, self.ref)
+
+
+class pushupdate(shasrecord):
+    """(localref, localsha, remoteref, remotesha) line of the pre-push
+    input"""
+    __slots__ = ('localref', '_localsha', 'remoteref', '_remotesha')
+
+    def __init__(self, localref, localsha, remoteref, remotesha):
+        self.localref = localref
+        self._localsha = tobinary(localsha)
+        self.remoteref = remoteref
+        self._remotesha = tobinary(remotesha)
+
+    @property
+    def localsha(self):
+        return tohex(self._localsha)
+
+    @property
+    def remotesha(self):
+        return tohex(self._remotesha)
+
+    def astuple(self):
+        return (self.localref, self.localsha, self.remoteref, self.remotesha)
+
+
 class basegitinputparser(object):
     def scm(self):
         return 'git'
 
 
-class gitinforesolver(object):
+class gitbatchprocess(object):
+    """Long lived git process answering the requests written on its stdin
+
+    The process is started on first use and shared by all the threads of a
+    hook invocation. Subclasses define the command in args, the lines to
+    write for a request in requestlines and how to read an answer in
+    readone."""
+    args = None
+    bufsize = -1
+
     def __init__(self):
-        self.reporoot = None
-        if 'GIT_DIR' in os.environ:
-            gitdir = os.environ["GIT_DIR"]
-            self.reporoot = os.path.dirname(os.path.abspath(gitdir))
-        else:
-            self.reporoot = util.popen4("git rev-parse --show-toplevel")[1]\
-                                .read()\
-                                .strip()
+        self.proc = None
+        self.lock = threading.Lock()
+
+    def _start(self):
+        if self.proc is None:
+            self.proc = popen(self.args,
+                              stdin=lazysubprocess().PIPE,
+                              stdout=lazysubprocess().PIPE,
+                              bufsize=self.bufsize)
+
+    def _feed(self, requests):
+        lines = []
+        for r in requests:
+            lines.extend(self.requestlines(r))
+        self.proc.stdin.write(tobytes(''.join('%s\n' % l for l in lines)))
+        self.proc.stdin.flush()
+
+    def requestlines(self, request):
+        return [request]
+
+    def read(self, requests):
+        """Return the answers to requests, in the same order"""
+        with self.lock:
+            self._start()
+            if len(requests) == 1:
+                self._feed(requests)
+            else:
+                # git stops reading its input when the pipe to us is full,
+                # write from another thread so that we can drain it here
+                feeder = threading.Thread(target=self._feed,
+                                          args=(requests, ))
+                feeder.start()
+            res = [self.readone() for r in requests]
+            if len(requests) != 1:
+                feeder.join()
+            return res
+
+    def __reduce__(self):
+        # The process is private to the interpreter that started it
+        return (self.__class__, ())
+
+    def close(self):
+        with self.lock:
+            if self.proc is not None:
+                self.proc.stdin.close()
+                self.proc.stdout.close()
+                self.proc.wait()
+                self.proc = None
+
+
+class gitcatfilebatch(gitbatchprocess):
+    """Long lived `git cat-file --batch` process
+
+    Object names are written one per line on stdin, git answers each of them
+    with a '<sha> <type> <size>' header followed by the raw content, or with
+    '<name> missing' if the object does not exist. read returns a list of
+    (type, content) tuples, None for the objects that could not be found"""
+    args = ['git', 'cat-file', '--batch']
+
+    def readheader(self):
+        """(type, size) of the next answer, None for missing objects"""
+        header = tostr(self.proc.stdout.readline()).split()
+        if len(header) != 3:
+            # '<name> missing' or '<name> ambiguous'
+            return None
+        return header[1], int(header[2])
+
+    def readone(self):
+        header = self.readheader()
+        if header is None:
+            return None
+        objtype, size = header
+        content = self.proc.stdout.read(size)
+        self.proc.stdout.read(1)  # trailing newline
+        return objtype, content
+
+    def stream(self, requests, streamsize):
+        """Yield the answers to requests like read does, except that the
+        contents larger than streamsize are blobstreams reading them from
+        git as they are consumed. The process is held until the generator
+        is exhausted or closed, it should not be shared with other readers.
+        What is left of a blobstream is skipped when the next answer is
+        asked for."""
+        with self.lock:
+            self._start()
+            feeder = threading.Thread(target=self._feed, args=(requests, ))
+            feeder.start()
+            left = len(requests)
+            current = None
+            try:
+                while left:
+                    header = self.readheader()
+                    left -= 1
+                    if header is None:
+                        yield None
+                        continue
+                    objtype, size = header
+                    current = blobstream(self.proc.stdout, size)
+                    if size <= streamsize:
+                        content = current.read()
+                        self.proc.stdout.read(1)
+                        current = None
+                        yield objtype, content
+                    else:
+                        yield objtype, current
+                        current.skip()
+                        self.proc.stdout.read(1)
+                        current = None
+            finally:
+                # the caller stopped early, skip the answers it did not read
+                # for the next requests to get theirs
+                if current is not None:
+                    current.skip()
+                    self.proc.stdout.read(1)
+                while left:
+                    header = self.readheader()
+                    left -= 1
+                    if header is not None:
+                        blobstream(self.proc.stdout, header[1] + 1).skip()
+                feeder.join()
+
+
+class gitcatfilecheck(gitbatchprocess):
+    """Long lived `git cat-file --batch-check` process, reading the type
+    and size of objects without their content. read returns a list of
+    (type, size) tuples, None for the objects that could not be found"""
+    args = ['git', 'cat-file', '--batch-check']
+
+    def readone(self):
+        header = tostr(self.proc.stdout.readline()).split()
+        if len(header) != 3:
+            return None
+        return header[1], int(header[2])
 
-        self._revs = None
+
+class blobstream(object):
+    """File-like reader of the size bytes of an object output by git"""
+    chunksize = 1 << 16
+
+    def __init__(self, out, size):
+        self.out = out
+        self.size = size
+        self.left = size
+
+    def read(self, n=-1):
+        if n < 0 or n > self.left:
+            n = self.left
+        data = self.out.read(n)
+        self.left -= len(data)
+        return data
+
+    def __iter__(self):
+        """Iterate over chunks of the content"""
+        while self.left:
+            yield self.read(self.chunksize)
+
+    def skip(self):
+        for chunk in self:
+            pass
+
+
+changedfile = collections.namedtuple('changedfile', ['status', 'path',
+                                                     'oldmode', 'newmode',
+                                                     'oldsha', 'newsha'])
+
+
+def parserawdiff(out):
+    """changedfile records of the output of a git diff --raw -z command"""
+    fields = out.split('\0')
+    changes = []
+    for i in range(0, len(fields) - 1, 2):
+        oldmode, newmode, oldsha, newsha, status = fields[i][1:].split()
+        changes.append(changedfile(status, fields[i + 1], oldmode, newmode,
+                                   oldsha, newsha))
+    return changes
+
+
+class gitdifftreebatch(gitbatchprocess):
+    """Long lived `git diff-tree --stdin -z -r` process
+
+    Commit shas are written one per line on stdin, git answers with the
+    commit sha and one ':<old mode> <new mode> <old sha> <new sha> <status>'
+    record per changed file, followed by its path, all terminated by NUL.
+    Commits without changes (and merges) get no answer at all, so each
+    commit is followed by a line that is not a commit, that git echoes as
+    is: the end of the answer. read returns a list of changedfile records
+    for each commit."""
+    args = ['git', 'diff-tree', '--stdin', '-z', '-r', '--root']
+    # the answers are parsed from the raw pipe, see readuntil
+    bufsize = 0
+    end = 'hooklib-end-of-changes'
+
+    def __init__(self):
+        super(gitdifftreebatch, self).__init__()
+        self.buf = b''
+        self.pos = 0
+
+    def requestlines(self, rev):
+        return [rev, self.end]
+
+    def peek(self):
+        """First byte of the next token, ':' for a file record, 'h' for the
+        end of an answer and an hex digit for a commit sha"""
+        while self.pos == len(self.buf):
+            self.fill()
+        return tostr(self.buf[self.pos:self.pos + 1])
+
+    def fill(self):
+        chunk = os.read(self.proc.stdout.fileno(), 65536)
+        if not chunk:
+            raise EOFError('git diff-tree exited')
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+
+    def readuntil(self, delim):
+        while True:
+            end = self.buf.find(delim, self.pos)
+            if end != -1:
+                data = self.buf[self.pos:end]
+                self.pos = end + 1
+                return tostr(data)
+            self.fill()
+
+    def readone(self):
+        changes = []
+        while True:
+            first = self.peek()
+            if first == ':':
+                meta = self.readuntil(b'\0')[1:].split()
+                path = self.readuntil(b'\0')
+                oldmode, newmode, oldsha, newsha, status = meta
+                changes.append(changedfile(status, path, oldmode, newmode,
+                                           oldsha, newsha))
+            elif first == 'h':
+                self.readuntil(b'\n')
+                return changes
+            else:
+                self.readuntil(b'\0')  # commit sha
+
+
+class gitinforesolver(memoized):
+    """Lazily compute information about the repo
+
+    Every field is computed on first access and cached for the duration of
+    the hook invocation, see hooklib_util.cachedproperty. Hooks share the
+    data they derive from it with memo, see hooklib_util.memoized
+
+    refsupdated tells whether the received refs already point to their new
+    value (post-receive)."""
+    # the staged files mapped by stagedblobsfor, see there
+    mapminsize = 1 << 16
+    mapmax = 256
+
+    def __init__(self, refsupdated=False):
+        self._refsupdated = refsupdated
+        self._difftree = gitdifftreebatch()
+
+    @cachedproperty
+    def _objects(self):
+        """Backend reading the objects, see hooklib_gitodb"""
+        import hooklib_gitodb
+        return hooklib_gitodb.openbackend()
 
     def commitmessagefor(self, rev):
-        return util.popen4("git cat-file commit %s | sed '1,/^$/d'" % rev)[1]\
-                    .read().strip()
+        return self.memo(('commitmessage', rev),
+                         lambda: self.commitmessagesfor([rev])[0])
 
-    @property
+    def prefetch(self, revs):
+        """Read the commit messages of revs with a single request, for the
+        next commitmessagefor calls, see hooklib.basecommithook"""
+        for rev, msg in zip(revs, self.commitmessagesfor(revs)):
+            self._memo.store(('commitmessage', rev), msg)
+
+    def commitmessagesfor(self, revs):
+        """Return the commit messages of all the revs with a single request
+        to the object backend, in the same order as revs"""
+        objs = self._objects.read(['%s^{commit}' % r for r in revs])
+        msgs = []
+        for rev, obj in zip(revs, objs):
+            if obj is None:
+                raise ValueError('Unknown revision %s' % rev)
+            msgs.append(tostr(obj[1]).partition('\n\n')[2].strip())
+        return msgs
+
+    @cachedproperty
+    def _catfile(self):
+        """cat-file process reading blobs, the one of the object backend"""
+        return getattr(self._objects, 'fallback', self._objects)
+
+    @cachedproperty
+    def _catfilecheck(self):
+        return gitcatfilecheck()
+
+    def blobfor(self, rev, path):
+        """Content (bytes) of path at rev, None if it is not a file of rev"""
+        return self.blobsfor([(rev, path)])[0]
+
+    def blobsizesfor(self, pairs):
+        """Sizes of the files of the (rev, path) pairs, without reading
+        them, None for the paths that are not files"""
+        headers = self._catfilecheck.read(['%s:%s' % p for p in pairs])
+        return [h[1] if h is not None and h[0] == 'blob' else None
+                for h in headers]
+
+    def blobsfor(self, pairs, maxsize=None):
+        """Contents (bytes) of the files of the (rev, path) pairs, read by
+        a single request to git. With maxsize, the files larger than
+        maxsize are not read, their content is None like the content of
+        missing files"""
+        pairs = list(pairs)
+        wanted = range(len(pairs))
+        if maxsize is not None:
+            sizes = self.blobsizesfor(pairs)
+            wanted = [i for i in wanted
+                      if sizes[i] is not None and sizes[i] <= maxsize]
+        blobs = [None] * len(pairs)
+        if not wanted:
+            return blobs
+        objs = self._catfile.read(['%s:%s' % pairs[i] for i in wanted])
+        for i, obj in zip(wanted, objs):
+            if obj is not None and obj[0] == 'blob':
+                blobs[i] = obj[1]
+        return blobs
+
+    def iterblobs(self, pairs, maxsize=None, streamsize=1 << 20):
+        """Yield the (rev, path) pairs with their content like blobsfor,
+        without keeping the large files in memory: the contents larger
+        than streamsize are file-like blobstreams that must be read before
+        asking for the next pair. The contents are read by a cat-file
+        process of their own, the other methods of the resolver can be
+        used while iterating.
+
+            for (rev, path), blob in revdata.iterblobs(pairs):
+                chunks = [blob] if isinstance(blob, bytes) else blob
+                for chunk in chunks:
+                    ...
+        """
+        pairs = list(pairs)
+        if maxsize is not None:
+            sizes = self.blobsizesfor(pairs)
+        requests = []
+        for i, pair in enumerate(pairs):
+            if maxsize is None or (sizes[i] is not None and
+                                   sizes[i] <= maxsize):
+                requests.append(i)
+        catfile = gitcatfilebatch()
+        answers = catfile.stream(['%s:%s' % pairs[i] for i in requests],
+                                 streamsize)
+        try:
+            i = 0
+            # not zip, it reads all the answers on python 2
+            for n, obj in enumerate(answers):
+                index = requests[n]
+                for skipped in pairs[i:index]:
+                    yield skipped, None
+                i = index + 1
+                yield pairs[index], obj[1] if obj and obj[0] == 'blob' \
+                    else None
+            for skipped in pairs[i:]:
+                yield skipped, None
+        finally:
+            answers.close()
+            catfile.close()
+
+    @cachedproperty
+    def stagedfiles(self):
+        """changedfile records of the changes staged for the next commit,
+        from a single git diff --cached. Unmerged paths have status 'U'"""
+        return parserawdiff(readcmd(['git', 'diff', '--cached', '--raw', '-z',
+                                     '--no-abbrev', '--no-renames',
+                                     '--no-ext-diff', '--no-color']))
+
+    @cachedproperty
+    def unstagedpaths(self):
+        """Set of the paths whose working tree copy differs from the staged
+        one"""
+        out = readcmd(['git', 'diff', '--name-only', '-z', '--no-renames',
+                       '--no-ext-diff', '--no-color'])
+        return set(out.split('\0')[:-1])
+
+    def stagedblobsfor(self, paths, mapworktree=False):
+        """Staged contents of paths, the version that is committed, read
+        with a single request to the object backend. The contents are None
+        for the paths that are not staged files (deleted, unmerged,
+        unchanged paths and submodules).
+
+        With mapworktree, the files of at least mapminsize bytes whose
+        working tree copy is the staged one are not read: their content is
+        the read-only mmap of the working tree file. Its bytes are the file
+        after the smudge filters of git, like the line endings set by
+        core.autocrlf. An mmap holds a file descriptor until it is closed,
+        at most mapmax files are mapped by a call."""
+        staged = dict((c.path, c) for c in self.stagedfiles)
+        blobs = [None] * len(paths)
+        tomap, toread = [], []
+        for i, path in enumerate(paths):
+            change = staged.get(path)
+            if change is None or change.status in ('D', 'U') or \
+               change.newmode not in ('100644', '100755', '120000'):
+                continue
+            if mapworktree and len(tomap) < self.mapmax and \
+               change.newmode != '120000' and \
+               path not in self.unstagedpaths and \
+               self.worktreesize(path) >= self.mapminsize:
+                tomap.append(i)
+            else:
+                toread.append(i)
+        if tomap and not toread:
+            # for the backend to get the file descriptors it needs before
+            # the maps take theirs
+            toread.append(tomap.pop())
+        self.readstaged(paths, blobs, toread, staged)
+        for n, i in enumerate(tomap):
+            blobs[i] = self.mapworktreefile(paths[i])
+            if blobs[i] is None:
+                # most likely out of file descriptors, read the others
+                self.readstaged(paths, blobs, tomap[n:], staged)
+                break
+        return blobs
+
+    def readstaged(self, paths, blobs, indices, staged):
+        if indices:
+            objs = self._objects.read([staged[paths[i]].newsha
+                                       for i in indices])
+            for i, obj in zip(indices, objs):
+                if obj is not None:
+                    blobs[i] = obj[1]
+
+    def worktreesize(self, path):
+        try:
+            return os.path.getsize(os.path.join(self.reporoot, path))
+        except OSError:
+            return -1
+
+    def mapworktreefile(self, path):
+        """mmap of a file of the working tree, None if it cannot be mapped
+        (files removed since git diff ran or no file descriptor left)"""
+        import mmap
+        try:
+            with open(os.path.join(self.reporoot, path), 'rb') as f:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (EnvironmentError, ValueError):
+            return None
+
+    def changedfilesfor(self, rev):
+        """Return the files changed by rev compared to its parent, as a list
+        of changedfile records (status, path, oldmode, newmode, oldsha,
+        newsha). status is one of 'A', 'D', 'M' or 'T'. Merges have no
+        changed files."""
+        return self.changedfilesfor_many([rev])[0]
+
+    def changedfilesfor_many(self, revs):
+        """Return the changed files of all the revs with a single request
+        to the diff-tree process, in the same order as revs"""
+        return self._difftree.read(self.fullshas(revs))
+
+    def fullshas(self, revs):
+        """Resolve revs to full shas, git is only run if some revs are not
+        already full shas"""
+        names = [r for r in revs if not isfullsha(r)]
+        if not names:
+            return list(revs)
+        shas = readcmd(['git', 'rev-parse'] + names).split()
+        if len(shas) != len(names):
+            raise ValueError('Unknown revision in %s' % ' '.join(names))
+        resolved = dict(zip(names, shas))
+        return [resolved.get(r, r) for r in revs]
+
+    @cachedproperty
+    def changedfiles(self):
+        """Sorted paths of the files changed by any of revs"""
+        paths = set()
+        for revs in self.iterrevs(batch=1000):
+            for changes in self.changedfilesfor_many(revs):
+                paths.update(c.path for c in changes)
+        return sorted(paths)
+
+    def acommitmessagefor(self, rev):
+        """Coroutine version of commitmessagefor, see hooklib_async"""
+        import hooklib_async
+        return hooklib_async.gitcommitmessagefor(self, rev)
+
+    def close(self):
+        """Stop the helper processes started by the resolver"""
+        if '_objects' in self.__dict__:
+            self._objects.close()
+        if '_catfilecheck' in self.__dict__:
+            self._catfilecheck.close()
+        self._difftree.close()
+
+    def __getstate__(self):
+        """Only the fields computed so far are pickled, when the resolver
+        is sent to another process, see hooklib.processhookrunner"""
+        state = self.__dict__.copy()
+        state.pop('_cachelocks', None)
+        return state
+
+    @cachedproperty
+    def reporoot(self):
+        if 'GIT_DIR' in os.environ:
+            gitdir = os.environ["GIT_DIR"]
+            return os.path.dirname(os.path.abspath(gitdir))
+        return readcmd(['git', 'rev-parse', '--show-toplevel']).strip()
+
+    @cachedproperty
     def head(self):
-        return util.popen4("git rev-parse HEAD")[1].read().strip()
+        return readcmd(['git', 'rev-parse', 'HEAD']).strip()
 
-    @property
+    @cachedproperty
     def revs(self):
-        if self._revs:
-            return self._revs
-        raw = util.popen4('git rev-list %s..%s' % (self.old, self.new))[1]\
-                  .read()\
-                  .strip()
-        if raw != '':
-            return raw.split("\n")
-        else:
-            return []
+        if 'receivedrevs' in self.__dict__:
+            return self.newrevs
+        return shalist(self.streamrevs())
 
     def setrevs(self, revs):
-        self._revs = revs
+        self.revs = revs
+
+    def revlistargs(self):
+        """Arguments of the rev-list command listing revs, None if there is
+        no rev"""
+        if iszero(self.new):
+            return None
+        if iszero(self.old):
+            # new ref, its commits are those not on any other ref
+            return [self.new, '--not', '--glob=refs/*']
+        return ['%s..%s' % (self.old, self.new)]
+
+    def newrevlist(self, parents=False):
+        """Run the rev-list listing in a single pass the commits of the
+        received refs not already in the repo, return its output lines"""
+        tips = [new for old, new, ref in self.receivedrevs if not iszero(new)]
+        if not tips:
+            return []
+        olds = ['^' + old for old, new, ref in self.receivedrevs
+                if not iszero(old)]
+        args = ['git', 'rev-list', '--stdin', '--not']
+        if parents:
+            args.insert(2, '--parents')
+        if self._refsupdated:
+            # post-receive, the refs already point to the new commits
+            args += ['--exclude=%s' % ref for _, _, ref in self.receivedrevs]
+        # not --all, it includes HEAD which --exclude does not apply to
+        args.append('--glob=refs/*')
+        return readcmd(args, input='\n'.join(tips + olds)).splitlines()
+
+    @cachedproperty
+    def newrevs(self):
+        if '_parents' in self.__dict__:
+            return self._parents[0]
+        return shalist(self.newrevlist())
+
+    @cachedproperty
+    def _parents(self):
+        """The new commits in rev-list order, with a dict of their binary
+        sha => binary shas of their parents. Only newrevsbyref needs the
+        parents, newrevs alone takes 20 bytes per commit"""
+        order, parents = shalist(), {}
+        for line in self.newrevlist(parents=True):
+            nodes = [tobinary(sha) for sha in line.split()]
+            order.appendbinary(nodes[0])
+            parents[nodes[0]] = tuple(nodes[1:])
+        return order, parents
+
+    @cachedproperty
+    def newrevsbyref(self):
+        order, parents = self._parents
+        byref = {}
+        positions = None
+        for old, new, ref in self.receivedrevs:
+            reachable = set()
+            new = tobinary(new)
+            stack = [new] if new in parents else []
+            while stack:
+                node = stack.pop()
+                if node not in reachable:
+                    reachable.add(node)
+                    stack.extend(p for p in parents[node] if p in parents)
+            revs = byref[ref] = shalist(width=order.width)
+            if not reachable:
+                continue
+            if positions is None:
+                positions = dict((order.binary(i), i)
+                                 for i in range(len(order)))
+            # in rev-list order, without scanning all the new commits
+            for node in sorted(reachable, key=positions.__getitem__):
+                revs.appendbinary(node)
+        return byref
+
+    def streamrevs(self):
+        """Yield the revs from a rev-list pipe as git outputs them"""
+        args = self.revlistargs()
+        if args is None:
+            return
+        with open(os.devnull, 'w') as devnull:
+            proc = popen(['git', 'rev-list'] + args,
+                         stdout=lazysubprocess().PIPE, stderr=devnull,
+                         bufsize=-1)
+        try:
+            for line in proc.stdout:
+                yield tostr(line).strip()
+        finally:
+            proc.stdout.close()
+            if proc.poll() is None:
+                # the caller stopped iterating early
+                proc.kill()
+            proc.wait()
+
+    def iterrevs(self, batch=None):
+        """Iterate over revs without waiting for git to list all of them,
+        keeping memory flat on huge pushes. revs is not filled.
+
+        With batch, lists of up to batch revs are yielded instead of single
+        revs, to feed the methods taking many revs like commitmessagesfor"""
+        if 'revs' in self.__dict__ or 'receivedrevs' in self.__dict__:
+            revs = iter(self.revs)
+        else:
+            revs = self.streamrevs()
+        if batch is None:
+            return revs
+        return batches(revs, batch)
 
 
 class gitpostupdateinputparser(basegitinputparser):
@@ -73,7 +851,8 @@ class gitupdateinputparser(basegitinputparser):
     - head (str) => sha1 of HEAD
     - refname (str) => refname that is updated, like 'refs/heads/master'
     - old (str) => old sha of the ref
-    - new (str) => new sha of the ref"""
+    - new (str) => new sha of the ref
+    - revs (list of sha1 (str)) => commits added to the ref"""
     def parse(self):
         refname, old, new = sys.argv[1:]
         resolver = gitinforesolver()
@@ -88,7 +867,11 @@ class gitprecommitinputparser(basegitinputparser):
 
     Available fields:
     - reporoot (str) => root of the repo
-    - head (str) => sha1 of HEAD"""
+    - head (str) => sha1 of HEAD
+    - stagedfiles (list of changedfile) => changes staged for the commit,
+        their content is read with stagedblobsfor(paths)
+    - unstagedpaths (set of str) => paths changed in the working tree since
+        they were staged"""
     def parse(self):
         resolver = gitinforesolver()
         return resolver
@@ -139,10 +922,13 @@ class gitpreautogcinputparser(basegitinputparser):
 
 
 class gitreceiveinputparser(basegitinputparser):
+    refsupdated = False
+
     def parse(self):
-        resolver = gitinforesolver()
+        resolver = gitinforesolver(self.refsupdated)
         rawrevs = hooklib_input.readlines()
-        revs = tuple([tuple(line.strip().split(' ')) for line in rawrevs])
+        revs = tuple([refupdate(*line.strip().split(' '))
+                      for line in rawrevs])
         resolver.receivedrevs = revs
         return resolver
 
@@ -153,9 +939,13 @@ class gitpostreceiveinputparser(gitreceiveinputparser):
     available fields:
     - reporoot (str) => root of the repo
     - receivedrevs =>
-        (list of tuples: (<old-value> <new-value> <ref-name>))
+        (list of refupdate tuples: (<old-value> <new-value> <ref-name>))
+    - revs, newrevs (shalist of sha1 (str)) => commits added to the repo by
+        the push, each of them listed once
+    - newrevsbyref (dict of ref-name => shalist of sha1 (str)) => commits
+        added to the repo by each ref, empty for deleted refs
     - head (str) => sha1 of HEAD"""
-    pass
+    refsupdated = True
 
 
 class gitprereceiveinputparser(gitreceiveinputparser):
@@ -164,7 +954,11 @@ class gitprereceiveinputparser(gitreceiveinputparser):
     available fields:
     - reporoot (str) => root of the repo
     - receivedrevs =>
-        (list of tuples: (<old-value> <new-value> <ref-name>))
+        (list of refupdate tuples: (<old-value> <new-value> <ref-name>))
+    - revs, newrevs (shalist of sha1 (str)) => commits the push adds to the
+        repo, each of them listed once
+    - newrevsbyref (dict of ref-name => shalist of sha1 (str)) => commits
+        each ref adds to the repo, empty for deleted refs
     - head (str) => sha1 of HEAD"""
     pass
 
@@ -175,12 +969,14 @@ class gitprepushinputparser(basegitinputparser):
     available fields:
     - reporoot (str) => root of the repo
     - revstobepushed =>
-        (list of tuples: <local ref> <local sha1> <remote ref> <remote sha1>))
+        (list of pushupdate tuples:
+         <local ref> <local sha1> <remote ref> <remote sha1>))
     - head (str) => sha1 of HEAD"""
     def parse(self):
         resolver = gitinforesolver()
         rawrevs = hooklib_input.readlines()
-        revs = tuple([tuple(line.strip().split(' ')) for line in rawrevs])
+        revs = tuple([pushupdate(*line.strip().split(' '))
+                      for line in rawrevs])
         resolver.revstobepushed = revs
         return resolver
 
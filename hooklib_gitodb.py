@@ -0,0 +1,444 @@
+"""Backends reading git objects for gitinforesolver
+
+A backend has a read(names) method returning, for each object name, a
+(type, content) tuple or None if the object does not exist, like
+hooklib_git.gitcatfilebatch which is the subprocess backend. The in-process
+backends read the objects named by their sha (optionally followed by
+^{commit}) without starting any process and hand the other names, and the
+objects they cannot find, to a cat-file process.
+
+HOOKLIB_GIT_BACKEND selects the backend: 'subprocess', 'pygit2', 'python'
+or 'auto' (the default) for pygit2 when it is installed and the pure python
+reader otherwise. The in-process backends honor GIT_OBJECT_DIRECTORY and
+GIT_ALTERNATE_OBJECT_DIRECTORIES, the objects of a push waiting in the
+quarantine directory of pre-receive are visible to them."""
+import binascii
+import mmap
+import os
+import struct
+import threading
+import zlib
+from hooklib_git import gitcatfilebatch, isfullsha
+from hooklib_util import readcmd, tostr
+
+TYPES = {1: 'commit', 2: 'tree', 3: 'blob', 4: 'tag'}
+OFS_DELTA = 6
+REF_DELTA = 7
+
+
+def openbackend(name=None):
+    """Return a new backend, selected by name or HOOKLIB_GIT_BACKEND"""
+    if name is None:
+        name = os.environ.get('HOOKLIB_GIT_BACKEND', 'auto')
+    if name == 'auto':
+        try:
+            import pygit2  # noqa: F401, only checks that it is installed
+            name = 'pygit2'
+        except ImportError:
+            name = 'python'
+    if name == 'subprocess':
+        return gitcatfilebatch()
+    elif name == 'pygit2':
+        return pygit2backend()
+    elif name == 'python':
+        return pythonbackend()
+    raise ValueError('Unknown git backend %s' % name)
+
+
+def findgitdir():
+    """The git directory holding the objects of the current repo"""
+    gitdir = os.environ.get('GIT_DIR')
+    if gitdir is None:
+        path = os.getcwd()
+        while True:
+            dotgit = os.path.join(path, '.git')
+            if os.path.isdir(dotgit):
+                gitdir = dotgit
+                break
+            elif os.path.isfile(dotgit):
+                # worktree or submodule, '.git' names the real directory
+                with open(dotgit) as f:
+                    target = f.read().strip().split(': ', 1)[1]
+                gitdir = os.path.join(path, target)
+                break
+            elif os.path.isfile(os.path.join(path, 'HEAD')) and \
+                    os.path.isdir(os.path.join(path, 'objects')):
+                gitdir = path  # bare repo
+                break
+            parent = os.path.dirname(path)
+            if parent == path:
+                return readcmd(['git', 'rev-parse', '--git-dir']).strip()
+            path = parent
+    commondir = os.path.join(gitdir, 'commondir')
+    if os.path.isfile(commondir):
+        with open(commondir) as f:
+            gitdir = os.path.join(gitdir, f.read().strip())
+    return os.path.abspath(gitdir)
+
+
+def objectdirs():
+    """The object directories of the current repo, the main one first and
+    then its alternates"""
+    main = os.environ.get('GIT_OBJECT_DIRECTORY')
+    if main is None:
+        main = os.path.join(findgitdir(), 'objects')
+    dirs = [os.path.abspath(main)]
+    alternates = os.environ.get('GIT_ALTERNATE_OBJECT_DIRECTORIES')
+    if alternates:
+        dirs.extend(os.path.abspath(d) for d in alternates.split(os.pathsep)
+                    if d)
+    # info/alternates can chain, each path is relative to its directory
+    i = 0
+    while i < len(dirs):
+        try:
+            with open(os.path.join(dirs[i], 'info', 'alternates')) as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith('#'):
+                        d = os.path.normpath(os.path.join(dirs[i], line))
+                        if d not in dirs:
+                            dirs.append(d)
+        except IOError:
+            pass
+        i += 1
+    return dirs
+
+
+def splitname(name):
+    """Return the sha of an object name and whether it is peeled to a
+    commit, sha is None for the names only git can resolve"""
+    peel = name.endswith('^{commit}')
+    if peel:
+        name = name[:-len('^{commit}')]
+    if not isfullsha(name):
+        return None, False
+    return name, peel
+
+
+class inprocessbackend(object):
+    """Read the objects named by sha with readsha, the other names by the
+    fallback cat-file process"""
+    def __init__(self):
+        self.fallback = gitcatfilebatch()
+        self.lock = threading.Lock()
+        self.opened = False
+
+    def __reduce__(self):
+        return (self.__class__, ())
+
+    def open(self):
+        """Find the objects of the repo, on first read"""
+        raise NotImplementedError()
+
+    def readsha(self, sha):
+        raise NotImplementedError()
+
+    def readone(self, name):
+        sha, peel = splitname(name)
+        if sha is None:
+            return None
+        obj = self.readsha(sha)
+        while peel and obj is not None and obj[0] == 'tag':
+            target = obj[1].split(b'\n', 1)[0].split(b' ')[1]
+            obj = self.readsha(tostr(target))
+        if peel and obj is not None and obj[0] != 'commit':
+            return None
+        return obj
+
+    def read(self, names):
+        with self.lock:
+            if not self.opened:
+                self.open()
+                self.opened = True
+        res = [self.readone(n) for n in names]
+        missing = [i for i, obj in enumerate(res) if obj is None]
+        if missing:
+            found = self.fallback.read([names[i] for i in missing])
+            for i, obj in zip(missing, found):
+                res[i] = obj
+        return res
+
+    def close(self):
+        self.fallback.close()
+
+
+class pygit2backend(inprocessbackend):
+    """Read the objects with libgit2"""
+    def open(self):
+        import pygit2
+        dirs = objectdirs()
+        self.repo = pygit2.Repository(findgitdir())
+        for d in dirs:
+            self.repo.odb.add_disk_alternate(d)
+
+    def readsha(self, sha):
+        try:
+            objtype, content = self.repo.odb.read(sha)
+        except KeyError:
+            return None
+        return TYPES[objtype], content
+
+
+def varint(data, pos):
+    """Decode the size encoding of deltas, return the value and the position
+    after it"""
+    value = shift = 0
+    while True:
+        c = data[pos]
+        pos += 1
+        value |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return value, pos
+
+
+def applydelta(base, delta):
+    delta = bytearray(delta)
+    srcsize, pos = varint(delta, 0)
+    dstsize, pos = varint(delta, pos)
+    if srcsize != len(base):
+        raise ValueError('delta does not apply to its base')
+    out = []
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+        if op & 0x80:
+            # copy from the base
+            offset = size = 0
+            for i in range(4):
+                if op & (1 << i):
+                    offset |= delta[pos] << (8 * i)
+                    pos += 1
+            for i in range(3):
+                if op & (0x10 << i):
+                    size |= delta[pos] << (8 * i)
+                    pos += 1
+            out.append(base[offset:offset + (size or 0x10000)])
+        elif op:
+            # insert the next op bytes
+            out.append(bytes(delta[pos:pos + op]))
+            pos += op
+        else:
+            raise ValueError('invalid delta opcode')
+    res = b''.join(out)
+    if len(res) != dstsize:
+        raise ValueError('delta result has the wrong size')
+    return res
+
+
+def mapfile(path):
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class packfile(object):
+    """A pack and its index, both mmap'd"""
+    def __init__(self, idxpath):
+        self.idx = mapfile(idxpath)
+        self.packpath = idxpath[:-len('.idx')] + '.pack'
+        self.pack = None
+        if self.idx[:4] == b'\377tOc':
+            version = struct.unpack('>I', self.idx[4:8])[0]
+            if version != 2:
+                raise ValueError('Unsupported pack index version %d' %
+                                 version)
+            self.fanout = struct.unpack('>256I', self.idx[8:1032])
+            self.count = self.fanout[255]
+            self.shas = 1032
+            self.offsets = self.shas + 24 * self.count
+            self.largeoffsets = self.offsets + 4 * self.count
+            self.entrysize = 20
+        else:
+            # version 1, (offset, sha) entries
+            self.fanout = struct.unpack('>256I', self.idx[:1024])
+            self.count = self.fanout[255]
+            self.shas = 1028
+            self.offsets = None
+            self.entrysize = 24
+
+    def shaat(self, i):
+        start = self.shas + i * self.entrysize
+        return self.idx[start:start + 20]
+
+    def offsetat(self, i):
+        if self.offsets is None:
+            start = self.shas - 4 + i * 24
+            return struct.unpack('>I', self.idx[start:start + 4])[0]
+        start = self.offsets + 4 * i
+        offset = struct.unpack('>I', self.idx[start:start + 4])[0]
+        if offset & 0x80000000:
+            start = self.largeoffsets + 8 * (offset & 0x7fffffff)
+            offset = struct.unpack('>Q', self.idx[start:start + 8])[0]
+        return offset
+
+    def find(self, binsha):
+        """Offset of the object in the pack, None if it is not there"""
+        first = bytearray(binsha[:1])[0]
+        lo = self.fanout[first - 1] if first else 0
+        hi = self.fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            sha = self.shaat(mid)
+            if sha == binsha:
+                return self.offsetat(mid)
+            elif sha < binsha:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def entry(self, offset):
+        """Return (type, data, base) for the entry at offset, data is the
+        delta and base the offset (OFS_DELTA) or sha (REF_DELTA) of its
+        base for deltified entries"""
+        if self.pack is None:
+            self.pack = mapfile(self.packpath)
+        header = bytearray(self.pack[offset:offset + 32])
+        c = header[0]
+        objtype = (c >> 4) & 7
+        size = c & 15
+        shift = 4
+        pos = 1
+        while c & 0x80:
+            c = header[pos]
+            pos += 1
+            size |= (c & 0x7f) << shift
+            shift += 7
+        base = None
+        if objtype == OFS_DELTA:
+            c = header[pos]
+            pos += 1
+            rel = c & 0x7f
+            while c & 0x80:
+                c = header[pos]
+                pos += 1
+                rel = ((rel + 1) << 7) | (c & 0x7f)
+            base = offset - rel
+        elif objtype == REF_DELTA:
+            base = bytes(header[pos:pos + 20])
+            pos += 20
+        return objtype, self.inflate(offset + pos, size), base
+
+    def inflate(self, start, size):
+        d = zlib.decompressobj()
+        chunks = []
+        got = 0
+        step = size + 64
+        while True:
+            data = self.pack[start:start + step]
+            if not data:
+                raise ValueError('truncated pack %s' % self.packpath)
+            start += step
+            chunk = d.decompress(data)
+            chunks.append(chunk)
+            got += len(chunk)
+            if got >= size or d.unused_data:
+                break
+            step = 65536
+        chunks.append(d.flush())
+        return b''.join(chunks)[:size]
+
+
+class pythonbackend(inprocessbackend):
+    """Read loose objects and mmap'd packs, in pure python"""
+    # number of delta bases kept in memory
+    basecachesize = 256
+
+    def open(self):
+        self.dirs = objectdirs()
+        self.packs = {}
+        self.scanlock = threading.Lock()
+        self.scanpacks()
+        self.bases = {}
+
+    def scanpacks(self):
+        """Open the packs not opened yet, return whether there were any"""
+        found = False
+        with self.scanlock:
+            for d in self.dirs:
+                packdir = os.path.join(d, 'pack')
+                try:
+                    names = os.listdir(packdir)
+                except OSError:
+                    continue
+                for name in names:
+                    path = os.path.join(packdir, name)
+                    if name.endswith('.idx') and path not in self.packs:
+                        try:
+                            self.packs[path] = packfile(path)
+                            found = True
+                        except (ValueError, EnvironmentError):
+                            # unsupported or being written, leave it to git
+                            self.packs[path] = None
+        return found
+
+    def readloose(self, sha):
+        for d in self.dirs:
+            try:
+                with open(os.path.join(d, sha[:2], sha[2:]), 'rb') as f:
+                    raw = zlib.decompress(f.read())
+            except IOError:
+                continue
+            header, _, content = raw.partition(b'\0')
+            return tostr(header.split(b' ')[0]), content
+        return None
+
+    def readpacked(self, binsha):
+        # a copy, other threads add the packs they find to self.packs
+        for pack in list(self.packs.values()):
+            if pack is not None:
+                offset = pack.find(binsha)
+                if offset is not None:
+                    return self.readentry(pack, offset)
+        return None
+
+    def readentry(self, pack, offset):
+        """Read an object from a pack, resolving its chain of deltas"""
+        deltas = []
+        while True:
+            cached = self.bases.get((pack.packpath, offset))
+            if cached is not None:
+                objtype, content = cached
+                break
+            objtype, data, base = pack.entry(offset)
+            if objtype == OFS_DELTA:
+                deltas.append((offset, data))
+                offset = base
+            elif objtype == REF_DELTA:
+                deltas.append((offset, data))
+                obj = self.readbinsha(base)
+                if obj is None:
+                    return None
+                objtype, content = obj
+                break
+            else:
+                objtype, content = TYPES[objtype], data
+                break
+        for offset, delta in reversed(deltas):
+            content = applydelta(content, delta)
+            # bases are often shared by the objects read together
+            if len(self.bases) >= self.basecachesize:
+                self.bases.clear()
+            self.bases[(pack.packpath, offset)] = (objtype, content)
+        return objtype, content
+
+    def readbinsha(self, binsha):
+        return self.readsha(tostr(binascii.hexlify(binsha)))
+
+    def readsha(self, sha):
+        binsha = binascii.unhexlify(sha)
+        obj = self.readpacked(binsha)
+        if obj is None:
+            obj = self.readloose(sha)
+        if obj is None and self.scanpacks():
+            # repacked or received since the packs were listed
+            obj = self.readpacked(binsha)
+        return obj
+
+    def close(self):
+        super(pythonbackend, self).close()
+        for pack in list(getattr(self, 'packs', {}).values()):
+            if pack is not None:
+                pack.idx.close()
+                if pack.pack is not None:
+                    pack.pack.close()
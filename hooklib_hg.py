@@ -1,4 +1,5 @@
-from mercurial import util
+from hooklib_util import cachedproperty, memoized, native, readcmd, tobytes
+from hooklib_util import tostr
 import os
 
 
@@ -7,14 +8,154 @@ class basehginputparser(object):
         return 'hg'
 
 
-class hginforesolver(basehginputparser):
+class hginforesolver(basehginputparser, memoized):
+    """Lazily compute information about the repo with the hg command
+
+    revs are the changesets added by the transaction, from node to
+    nodelast (HG_NODE and HG_NODE_LAST). The messages, authors and files of
+    all the revs are read by a single hg log command, the first time one of
+    them is needed."""
+    def __init__(self, node=None, nodelast=None):
+        self.node = node
+        self.nodelast = nodelast
+
+    @cachedproperty
+    def revs(self):
+        if self.node is None:
+            # hooks like precommit run before there is a changeset
+            return []
+        if self.nodelast is None or self.nodelast == self.node:
+            return [self.node]
+        return [rev for rev in self._commits]
+
+    def revset(self):
+        """Revset selecting revs"""
+        if 'revs' not in self.__dict__ and self.nodelast is not None:
+            return ['-r', '%s:%s' % (self.node, self.nodelast)]
+        args = []
+        for rev in self.revs:
+            args += ['-r', rev]
+        return args
+
+    def log(self, revargs):
+        """Return a dict of node => (message, author, files) for the revs
+        selected by revargs, keeping the order of hg log"""
+        import collections
+        import json
+        out = readcmd(['hg', 'log', '-v', '-T', 'json'] + revargs)
+        commits = collections.OrderedDict()
+        for entry in json.loads(out or '[]'):
+            commits[native(entry['node'])] = (
+                native(entry['desc']), native(entry['user']),
+                [native(f) for f in entry['files']])
+        return commits
+
+    @cachedproperty
+    def _commits(self):
+        revargs = self.revset()
+        # hg log without revs would list the whole repo
+        return self.log(revargs) if revargs else {}
+
+    def infofor(self, rev):
+        """(message, author, files) of rev, the revs not in revs are read
+        one by one"""
+        if rev in self._commits:
+            return self._commits[rev]
+        commits = self.log(['-r', rev])
+        if not commits:
+            raise ValueError('Unknown revision %s' % rev)
+        return list(commits.values())[0]
+
+    def prefetch(self, revs):
+        """Read the info of all the revs before checking them one by one,
+        see hooklib.basecommithook"""
+        self._commits
+
     def commitmessagefor(self, rev):
-        return util.popen4("hg log -r %s -T {desc}" % rev)[1].read()
+        return self.infofor(rev)[0]
+
+    def commitmessagesfor(self, revs):
+        return [self.infofor(rev)[0] for rev in revs]
+
+    def authorfor(self, rev):
+        return self.infofor(rev)[1]
+
+    def filesfor(self, rev):
+        """Files touched by rev"""
+        return self.infofor(rev)[2]
+
+    def acommitmessagefor(self, rev):
+        """Coroutine version of commitmessagefor, see hooklib_async"""
+        import hooklib_async
+        return hooklib_async.hgcommitmessagefor(rev)
+
+
+class hgrepoinforesolver(hginforesolver):
+    """Information about the repo read from the repo object given to
+    in-process hooks, see hghook"""
+    def __init__(self, repo, node=None, nodelast=None):
+        super(hgrepoinforesolver, self).__init__(node, nodelast)
+        self.repo = repo
+
+    @cachedproperty
+    def reporoot(self):
+        return tostr(self.repo.root)
+
+    def log(self, revargs):
+        import collections
+        revset = ' + '.join('(%s)' % a for a in revargs[1::2])
+        commits = collections.OrderedDict()
+        for r in self.repo.revs(tobytes(revset)):
+            ctx = self.repo[r]
+            commits[tostr(ctx.hex())] = (
+                tostr(ctx.description()), tostr(ctx.user()),
+                [tostr(f) for f in ctx.files()])
+        return commits
+
+    def acommitmessagefor(self, rev):
+        """Coroutine version of commitmessagefor, see hooklib_async"""
+        import asyncio
+        future = asyncio.Future()
+        future.set_result(self.commitmessagefor(rev))
+        return future
+
+
+def hghook(hooks, **options):
+    """Make an in-process mercurial hook running hooks, options are the
+    keyword arguments of hooklib.makerunner: those of runhooks except
+    detached and retries, the spool is for git hooks, and without 'process'
+    parallelism.
+
+    In myhooks.py:
+        checkpush = hghook([nowip], parallel=True)
+    And in the hgrc of the repo:
+        [hooks]
+        pretxnchangegroup.hooklib = python:/path/to/myhooks.py:checkpush
+
+    The hooks read the repo from memory instead of starting hg commands,
+    revdata.revs are all the changesets added by the transaction."""
+    def hook(ui, repo, hooktype, node=None, node_last=None, **kwargs):
+        from hooklib import makerunner
+        runoptions = dict(options)
+        if runoptions.get('cache') is True:
+            runoptions['cache'] = os.path.join(tostr(repo.path),
+                                               'hooklib-verdicts.sqlite')
+        revdata = hgrepoinforesolver(repo, node and tostr(node),
+                                     node_last and tostr(node_last))
+        runner = makerunner(tostr(hooktype), hooks, revdata=revdata,
+                            **runoptions)
+        ret = runner.evaluate()
+        if runner.logsink is not None:
+            runner.logsink.close()
+        else:
+            for m in runner.log.read():
+                ui.warn(tobytes(m + '\n'))
+        # a true value makes the hook fail
+        return not ret
+    return hook
 
 
 class hgupdateinputparser(basehginputparser):
     def parse(self):
-        rev = os.environ['HG_NODE']
-        resolver = hginforesolver()
-        resolver.revs = [rev]
-        return resolver
+        return hginforesolver(os.environ['HG_NODE'],
+                              os.environ.get('HG_NODE_LAST'))
@@ -1,5 +1,3 @@
-from hooklib_git import *
-from hooklib_hg import *
 import os
 import sys
 
@@ -9,70 +7,84 @@ def readlines():
     return sys.stdin.readlines()
 
 
+def backend(scm):
+    """Import the module implementing the parsers for scm
+
+    Backends are only imported once a phase selects them, a git hook never
+    pays for importing the hg backend and the other way around"""
+    if scm == 'git':
+        import hooklib_git
+        return hooklib_git
+    elif scm == 'hg':
+        import hooklib_hg
+        return hooklib_hg
+    raise NotImplementedError("Unknown SCM %s" % scm)
+
+
 class prepushinputparser(object):
     @staticmethod
     def findscm():
-        return gitprepushinputparser()
+        return backend('git').gitprepushinputparser()
 
 
 class prereceiveinputparser(object):
     @staticmethod
     def findscm():
-        return gitprereceiveinputparser()
+        return backend('git').gitprereceiveinputparser()
 
 
 class postreceiveinputparser(object):
     @staticmethod
     def findscm():
-        return gitpostreceiveinputparser()
+        return backend('git').gitpostreceiveinputparser()
 
 
 class preparecommitmsginputparser(object):
     @staticmethod
     def findscm():
-        return gitpreparecommitmsginputparser()
+        return backend('git').gitpreparecommitmsginputparser()
 
 
 class preautogcinputparser(object):
     @staticmethod
     def findscm():
-        return gitpreautogcinputparser()
+        return backend('git').gitpreautogcinputparser()
 
 
 class prerebaseinputparser(object):
     @staticmethod
     def findscm():
-        return gitprerebaseinputparser()
+        return backend('git').gitprerebaseinputparser()
 
 
 class postcommitinputparser(object):
     @staticmethod
     def findscm():
-        return gitpostcommitinputparser()
+        return backend('git').gitpostcommitinputparser()
 
 
 class preapplypatchinputparser(object):
     @staticmethod
     def findscm():
-        return gitpreapplypatchinputparser()
+        return backend('git').gitpreapplypatchinputparser()
 
 
 class postapplypatchinputparser(object):
     @staticmethod
     def findscm():
-        return gitpostapplypatchinputparser()
+        return backend('git').gitpostapplypatchinputparser()
 
 
 class applypatchmsginputparser(object):
     @staticmethod
     def findscm():
-        return gitapplypatchmsginputparser()
+        return backend('git').gitapplypatchmsginputparser()
 
 
 class commitmsginputparser(object):
     @staticmethod
     def findscm():
-        return gitcommitmsginputparser()
+        return backend('git').gitcommitmsginputparser()
 
 
 class postupdateinputparser(object):
@@ -81,7 +93,7 @@ class postupdateinputparser(object):
         """Find the correct type of postupdateinputparser
            based on the SCM used"""
         if 'GIT_DIR' in os.environ:
-            return gitpostupdateinputparser()
+            return backend('git').gitpostupdateinputparser()
         else:
             raise NotImplementedError("No implemented for your SCM")
 
@@ -91,9 +103,9 @@ class updateinputparser(object):
     def findscm():
         """Find the correct type of updateinputparser based on the SCM used"""
         if 'GIT_DIR' in os.environ:
-            return gitupdateinputparser()
+            return backend('git').gitupdateinputparser()
         elif 'HG_NODE' in os.environ:
-            return hgupdateinputparser()
+            return backend('hg').hgupdateinputparser()
         else:
             raise NotImplementedError("No implemented for your SCM")
 
@@ -102,7 +114,7 @@ class precommitinputparser(object):
     @staticmethod
     def findscm():
         if 'GIT_DIR' in os.environ:
-            return gitprecommitinputparser()
+            return backend('git').gitprecommitinputparser()
         else:
             raise NotImplementedError("No implemented for your SCM")
 
@@ -0,0 +1,145 @@
+"""Serve hooks from a long running process
+
+Starting an interpreter and importing the hooks dominates the cost of the
+hooks of small pushes. A hookserver loads the hook suites once and listens
+on a unix socket, the hooks installed in the repos are hooklib_client that
+forwards the argv, stdin, environment and working directory of the hook to
+the server and relays its output and exit code:
+
+    from hooklib_server import serve
+    serve('/tmp/hooklib.sock', {
+        'pre-receive': {'hooks': [nowip], 'parallel': True},
+        'update': {'hooks': [mastergate]},
+    })
+
+Each phase is given the keyword arguments of runhooks for it. Every request
+is handled in a process forked from the server: hooks run exactly as if
+git had started them, state they change is discarded with the process.
+
+The directory of the default socket is created private to the user, the
+server refuses to use it when another user could write to it."""
+import errno
+import os
+import stat
+import sys
+import tempfile
+import traceback
+try:
+    import SocketServer as socketserver
+except ImportError:
+    import socketserver
+import hooklib_input
+from hooklib import runhooks
+from hooklib_client import (FORWARDED, recvmsg, sendmsg, socketdir,
+                            socketpath)
+from hooklib_util import lazysubprocess, tostr
+
+
+def makeprivatedir(path):
+    """Create the directory path only accessible by the user, raise OSError
+    if it exists and others can access it"""
+    try:
+        os.mkdir(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    st = os.lstat(path)
+    if (not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid()
+            or st.st_mode & 0o077):
+        raise OSError(errno.EPERM, 'not a private directory', path)
+
+
+class hookhandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        request = recvmsg(self.request)
+        status, output = self.server.runrequest(request)
+        sendmsg(self.request, {'status': status, 'output': output})
+
+
+class hookserver(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    """Run the hooks of suites for the clients connecting to path
+
+    suites maps phase names to the keyword arguments of runhooks."""
+    def __init__(self, path, suites):
+        self.suites = suites
+        self.preload()
+        if os.path.dirname(path) == socketdir():
+            makeprivatedir(socketdir())
+        if os.path.exists(path):
+            os.unlink(path)
+        socketserver.UnixStreamServer.__init__(self, path, hookhandler)
+
+    def preload(self):
+        """Import what the requests need, for the forked processes to start
+        with it loaded"""
+        hooklib_input.backend('git')
+        hooklib_input.backend('hg')
+        lazysubprocess()
+        for options in self.suites.values():
+            # preloads: imported for the forks, not used here
+            if options.get('parallel') == 'process':
+                import multiprocessing  # noqa: F401
+            elif options.get('parallel') == 'async':
+                import hooklib_async  # noqa: F401
+
+    def setup(self, request):
+        """Make the process look like the hook started by the SCM"""
+        os.chdir(request['cwd'])
+        for k in list(os.environ):
+            if k.startswith(FORWARDED):
+                del os.environ[k]
+        os.environ.update(request['env'])
+        sys.argv = request['argv']
+        stdin = tempfile.TemporaryFile()
+        stdin.write(request['stdin'].encode('utf-8'))
+        stdin.seek(0)
+        os.dup2(stdin.fileno(), 0)
+        stdin.close()
+        # The output of the hooks and of the commands they start
+        output = tempfile.TemporaryFile()
+        os.dup2(output.fileno(), 1)
+        os.dup2(output.fileno(), 2)
+        # The server may have replaced the standard streams, with objects not
+        # writing to these file descriptors
+        sys.stdin = os.fdopen(0, 'r')
+        sys.stdout = os.fdopen(1, 'w', 1)
+        sys.stderr = os.fdopen(2, 'w', 1)
+        return output
+
+    def runrequest(self, request):
+        """Run the hooks of a request, return their exit code and output"""
+        output = self.setup(request)
+        phase = os.path.basename(request['argv'][0])
+        try:
+            if phase not in self.suites:
+                sys.stderr.write("no hooks for phase %s\n" % phase)
+                status = 1
+            else:
+                runhooks(phase, **self.suites[phase])
+                status = 0
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                status = e.code or 0
+            else:
+                sys.stderr.write("%s\n" % e.code)
+                status = 1
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        sys.stdout.flush()
+        sys.stderr.flush()
+        output.seek(0)
+        try:
+            return status, tostr(output.read())
+        finally:
+            output.close()
+
+
+def serve(path, suites):
+    """Serve the hooks of suites on the unix socket path forever, path is
+    the default path of hooklib_client when it is None"""
+    server = hookserver(path or socketpath(), suites)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -0,0 +1,194 @@
+"""Run post-receive and post-update hooks after the push returns
+
+The outcome of these hooks cannot reject a push, the client does not need
+to wait for them. With runhooks(..., detached=True), the hook writes its
+input to a spool directory under GIT_DIR and starts a worker in the
+background before returning: the worker is the hook script itself, run
+again with HOOKLIB_SPOOL_WORKER set, and it runs the hooks on the spooled
+pushes until the spool is empty.
+
+One worker drains the spool of a phase at a time, the others exit at once.
+The pushes waiting in the spool are run together: the updates of a ref are
+merged into one, from its first old value to its last new value. The
+hooks that fail are retried, with a delay doubling after each attempt,
+and the pushes for which they still fail are moved to the failed
+directory of the spool. The output of the worker goes to worker.log.
+A push is removed from the spool once its hooks ran, if the worker dies
+before that its hooks are run again by the next worker."""
+import collections
+import fcntl
+import json
+import os
+import sys
+import time
+import traceback
+import hooklib_input
+from hooklib_util import native, popen, readcmd
+
+WORKER = 'HOOKLIB_SPOOL_WORKER'
+PHASES = ('post-receive', 'post-update')
+
+
+def spooldir(phase):
+    gitdir = os.environ.get('GIT_DIR')
+    if gitdir is None:
+        gitdir = readcmd(['git', 'rev-parse', '--git-dir']).strip()
+    return os.path.join(gitdir, 'hooklib-spool', phase)
+
+
+def readinput(phase):
+    """The input of the hook, as stored in the spool"""
+    if phase == 'post-receive':
+        return {'receivedrevs': [line.split() for line in
+                                 hooklib_input.readlines() if line.strip()]}
+    return {'revs': sys.argv[1:]}
+
+
+def enqueue(path, entry):
+    """Write entry to the spool at path, the entry is on disk when this
+    returns"""
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    name = '%d-%d.json' % (int(time.time() * 1e6), os.getpid())
+    tmp = os.path.join(path, '.%s.tmp' % name)
+    with open(tmp, 'w') as f:
+        json.dump(entry, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, os.path.join(path, name))
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def pending(path):
+    """Paths of the entries of the spool at path, oldest first"""
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return []
+    return sorted(os.path.join(path, n) for n in names
+                  if n.endswith('.json') and not n.startswith('.'))
+
+
+def coalesce(entries):
+    """Merge the ref updates of entries: the updates of a ref become one
+    from its first old value to its last new value, refs back to their old
+    value are dropped"""
+    refs = collections.OrderedDict()
+    for entry in entries:
+        for old, new, ref in entry['receivedrevs']:
+            if ref in refs:
+                old = refs[ref][0]
+            refs[ref] = (old, new)
+    return [(old, new, ref) for ref, (old, new) in refs.items()
+            if old != new]
+
+
+def coalescerevs(entries):
+    """The revs of entries, each of them once"""
+    revs = collections.OrderedDict()
+    for entry in entries:
+        for rev in entry['revs']:
+            revs[rev] = True
+    return list(revs)
+
+
+def startworker(path):
+    """Start a worker draining the spool at path, detached from the hook"""
+    env = dict(os.environ)
+    env[WORKER] = '1'
+    with open(os.devnull) as devnull:
+        with open(os.path.join(path, 'worker.log'), 'a') as log:
+            popen([sys.executable] + sys.argv, env=env, stdin=devnull,
+                  stdout=log, stderr=log, preexec_fn=os.setsid)
+
+
+def log(msg):
+    sys.stderr.write('%s %s\n' % (time.strftime('%Y-%m-%d %H:%M:%S'), msg))
+    sys.stderr.flush()
+
+
+def spool(phase, hooks, **options):
+    """Spool the input of the hook and start a worker, or drain the spool
+    when called by the worker. See runhooks for options"""
+    if phase not in PHASES:
+        raise ValueError('%s hooks cannot be detached' % phase)
+    path = spooldir(phase)
+    if os.environ.get(WORKER):
+        # not passed on to the processes started by the hooks
+        del os.environ[WORKER]
+        drain(path, phase, hooks, **options)
+    else:
+        enqueue(path, readinput(phase))
+        startworker(path)
+
+
+def drain(path, phase, hooks, retries=2, retrydelay=1.0, maxbatch=100,
+          **options):
+    """Run hooks on the entries of the spool at path, maxbatch at a time,
+    until it is empty. Return at once if another worker is draining it"""
+    while pending(path):
+        with open(os.path.join(path, 'lock'), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                return
+            names = pending(path)
+            while names:
+                runbatch(path, phase, hooks, names[:maxbatch], retries,
+                         retrydelay, options)
+                names = pending(path)
+        # entries spooled while the lock was being released are run by the
+        # next iteration, the worker started for them found it held
+
+
+def runbatch(path, phase, hooks, names, retries, retrydelay, options):
+    """Run hooks on the entries names, retrying the failing hooks"""
+    from hooklib import makerunner
+    from hooklib_git import gitinforesolver, refupdate
+    entries = []
+    for name in names:
+        with open(name) as f:
+            entries.append(json.load(f))
+    revdata = gitinforesolver(refsupdated=phase == 'post-receive')
+    if phase == 'post-receive':
+        revdata.receivedrevs = tuple(
+            refupdate(*[native(v) for v in update])
+            for update in coalesce(entries))
+    else:
+        revdata.setrevs([native(rev) for rev in coalescerevs(entries)])
+    remaining = list(hooks)
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(retrydelay * 2 ** (attempt - 1))
+        runner = makerunner(phase, remaining, revdata=revdata, **options)
+        try:
+            runner.evaluate()
+        except Exception:
+            # a failed attempt, the hooks that did not pass are retried
+            log(traceback.format_exc().rstrip())
+        else:
+            if runner.logsink is None:
+                for m in runner.log.read():
+                    log(m)
+        results = getattr(runner, 'results', [])
+        remaining = [h for i, (h, _, _) in enumerate(runner.runlist)
+                     if i >= len(results) or not results[i].passed]
+        if not remaining:
+            break
+    revdata.close()
+    if not remaining:
+        for name in names:
+            os.unlink(name)
+        return
+    failed = os.path.join(path, 'failed')
+    if not os.path.isdir(failed):
+        os.makedirs(failed)
+    for name in names:
+        os.rename(name, os.path.join(failed, os.path.basename(name)))
+    log('%s failed after %d attempts, %d pushes moved to %s' %
+        (', '.join(h.__name__ for h in remaining), retries + 1, len(names),
+         failed))
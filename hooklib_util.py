@@ -0,0 +1,259 @@
+"""Internal helpers shared by the hooklib modules"""
+import resource
+import threading
+import time
+
+
+class cachedproperty(object):
+    """Property computed at most once per instance, on first access
+
+    The value is stored in the instance __dict__ under the property name,
+    later reads find it there and never go through the descriptor again.
+    The computation is serialized with a lock per instance and field, so that
+    parallel hooks reading the same field only pay for it once, without
+    waiting for the other fields being computed. Assigning the
+    attribute directly fills the cache, this is how input parsers provide
+    the values they already know."""
+    def __init__(self, fn):
+        self.fn = fn
+        self.name = fn.__name__
+        self.__doc__ = fn.__doc__
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        # dict.setdefault is atomic, all threads end up with the same lock
+        locks = obj.__dict__.setdefault('_cachelocks', {})
+        lock = locks.setdefault(self.name, threading.RLock())
+        with lock:
+            if self.name not in obj.__dict__:
+                obj.__dict__[self.name] = self.fn(obj)
+            return obj.__dict__[self.name]
+
+
+class artifactmemo(object):
+    """Values derived from revdata, shared by the hooks of a run
+
+    get(key, fn) returns the value computed by fn for key, fn is called at
+    most once at a time per key: the threads asking for a key being computed
+    wait for its value. The values are kept while their estimated size (see
+    sizeof) fits in budget bytes, the least recently used are evicted
+    first. Failures are not kept, the next request for the key calls fn
+    again."""
+    def __init__(self, budget=64 << 20):
+        import collections
+        self.budget = budget
+        self.size = 0
+        self.values = collections.OrderedDict()
+        self.inflight = {}
+        self.lock = threading.Lock()
+
+    def __reduce__(self):
+        # Values are not sent to other processes, they are recomputed there
+        return (artifactmemo, (self.budget, ))
+
+    def get(self, key, fn):
+        with self.lock:
+            if key in self.values:
+                value, size = self.values.pop(key)
+                self.values[key] = (value, size)
+                return value
+            flight = self.inflight.get(key)
+            owner = flight is None
+            if owner:
+                flight = self.inflight[key] = {'done': threading.Event()}
+        if not owner:
+            flight['done'].wait()
+            if 'error' in flight:
+                raise flight['error']
+            return flight['value']
+        try:
+            value = fn()
+        except Exception as e:
+            flight['error'] = e
+            raise
+        else:
+            flight['value'] = value
+            self.store(key, value)
+            return value
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            flight['done'].set()
+
+    def store(self, key, value):
+        size = sizeof(value)
+        if size > self.budget:
+            return
+        with self.lock:
+            if key in self.values:
+                self.size -= self.values.pop(key)[1]
+            self.values[key] = (value, size)
+            self.size += size
+            while self.size > self.budget:
+                _, (_, evicted) = self.values.popitem(last=False)
+                self.size -= evicted
+
+
+def sizeof(value):
+    """Approximate number of bytes used by value and the objects it holds"""
+    import sys
+    size = 0
+    seen = set()
+    stack = [value]
+    while stack:
+        v = stack.pop()
+        if id(v) in seen:
+            continue
+        seen.add(id(v))
+        size += sys.getsizeof(v)
+        if isinstance(v, dict):
+            stack.extend(v.keys())
+            stack.extend(v.values())
+        elif isinstance(v, (list, tuple, set, frozenset)):
+            stack.extend(v)
+        elif hasattr(v, '__dict__'):
+            stack.append(v.__dict__)
+    return size
+
+
+class memoized(object):
+    """Give resolvers a run scoped memo, see artifactmemo
+
+    Hooks share the values they derive from revdata with
+    revdata.memo(key, fn), like:
+        revdata.memo(('diff', rev), lambda: computediff(revdata, rev))
+    fn must not ask for its own key."""
+    memobudget = 64 << 20
+
+    @cachedproperty
+    def _memo(self):
+        return artifactmemo(self.memobudget)
+
+    def memo(self, key, fn):
+        return self._memo.get(key, fn)
+
+
+_local = threading.local()
+
+
+def threadcputime():
+    """CPU time used by the calling thread, or by the whole process on
+    platforms where threads cannot be told apart"""
+    if hasattr(time, 'thread_time'):
+        return time.thread_time()
+    # RUSAGE_THREAD is only exposed by python 3, its value on linux is 1
+    who = getattr(resource, 'RUSAGE_THREAD', 1)
+    try:
+        usage = resource.getrusage(who)
+    except (ValueError, resource.error):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class stopwatch(object):
+    """Measure the wall time, CPU time and number of processes spawned by
+    the calling thread within a with block. Only the processes started by
+    hooklib are counted (popen, hooklib_async.readcmd), not those started
+    with the subprocess module directly"""
+    def __init__(self):
+        self.wall = self.cpu = 0.0
+        self.forks = 0
+
+    @staticmethod
+    def current():
+        """The stopwatch running in the calling thread, None if there is
+        none"""
+        return getattr(_local, 'stopwatch', None)
+
+    def __enter__(self):
+        self.parent = stopwatch.current()
+        _local.stopwatch = self
+        self.wall -= time.time()
+        self.cpu -= threadcputime()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall += time.time()
+        self.cpu += threadcputime()
+        _local.stopwatch = self.parent
+
+    def add(self, other):
+        """Account the measures of other, taken by another thread working
+        for this one"""
+        self.wall += other.wall
+        self.cpu += other.cpu
+        self.forks += other.forks
+
+
+def countfork():
+    sw = stopwatch.current()
+    if sw is not None:
+        sw.forks += 1
+
+
+def popen(args, **kwargs):
+    """Start a subprocess, every process spawned by hooklib goes through
+    here. args is a list, no shell is involved"""
+    countfork()
+    return lazysubprocess().Popen(args, close_fds=True, **kwargs)
+
+
+def lazysubprocess():
+    """The subprocess module, imported on first use as it is slow to import
+    and many hooks never start a process"""
+    import subprocess
+    return subprocess
+
+
+def readcmd(args, input=None):
+    """Run a command and return its output, stderr is discarded"""
+    pipe = lazysubprocess().PIPE
+    if input is None:
+        proc = popen(args, stdout=pipe, stderr=pipe)
+        return tostr(proc.communicate()[0])
+    proc = popen(args, stdin=pipe, stdout=pipe, stderr=pipe)
+    return tostr(proc.communicate(tobytes(input))[0])
+
+
+def tostr(data):
+    """Decode the output of a command on python 3, noop on python 2"""
+    if isinstance(data, str):
+        return data
+    return data.decode('utf-8', 'replace')
+
+
+def native(s):
+    """The str of a value decoded from json, utf-8 encoded on python 2"""
+    if isinstance(s, str):
+        return s
+    return s.encode('utf-8')
+
+
+def tobytes(s):
+    """Encode the input of a command on python 3, noop on python 2"""
+    if isinstance(s, bytes):
+        return s
+    return s.encode('utf-8')
+
+
+def cpucount():
+    # multiprocessing is slow to import, only pay for it when needed
+    import multiprocessing
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def batches(iterable, size):
+    """Yield lists of size items from iterable, the last one can be
+    shorter"""
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -1,13 +1,33 @@
 import unittest
 import time
-from mock import MagicMock
+try:
+    from unittest.mock import MagicMock
+except ImportError:
+    from mock import MagicMock
 import hooklib_input
+import hooklib_util
+import hooklib_gitodb
+import hooklib_spool
+import threading
 from hooklib import hookrunner, basehook, parallelhookrunner
+from hooklib import processhookrunner, writeprofile, basecommithook
+from hooklib import scheduledhookrunner, hooktimings, logsink
+from hooklib_cache import verdictcache
 from hooklib_input import inputparser
 from hooklib_git import *
 from hooklib_hg import *
 import os
+import json
+import pickle
 import sys
+import shutil
+import socket
+import subprocess
+import tempfile
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
 
 ERROR_MSG = "ERROR ABC"
@@ -38,6 +58,39 @@ class slowfailinghook(basehook):
         return False
 
 
+class veryslowhook(basehook):
+    def check(self, log, revdata):
+        time.sleep(5)
+        return True
+
+
+class cpuboundhook(basehook):
+    def check(self, log, revdata):
+        log.write("pid %d" % sum(i for i in range(100000)))
+        return True
+
+
+class commitrevs(object):
+    revs = ['rev%02d' % i for i in range(20)]
+
+
+class pidcommithook(basecommithook):
+    # the processes do not share threads
+    threadsafe = False
+
+    def checkcommit(self, log, revdata, rev):
+        time.sleep(0.01)
+        log.write('%s %d' % (rev, os.getpid()))
+        return rev != 'rev07'
+
+
+class forkinghook(basehook):
+    def check(self, log, revdata):
+        hooklib_util.readcmd(['true'])
+        hooklib_util.readcmd(['true'])
+        return True
+
+
 class testhookrunner(unittest.TestCase):
     def test_passing_hook(self):
         """Passing hook works"""
@@ -76,10 +129,191 @@ class testhookrunner(unittest.TestCase):
         assert(runner.log.read()) == [ERROR_MSG, ERROR_MSG2]
 
 
+    def test_timeout(self):
+        """A hook running for too long fails and is told to stop"""
+        runner = hookrunner()
+        runner.register(veryslowhook, timeout=0.06)
+        runner.register(failinghook)
+        t1 = time.time()
+        assert(runner.evaluate() == False)
+        t2 = time.time()
+        assert (t2-t1) < 0.5
+        assert(runner.log.read() == ["veryslowhook timed out after 0.1s"])
+
+    def test_timeout_policy(self):
+        runner = hookrunner(timeoutpolicy='warn')
+        runner.register(veryslowhook, timeout=0.01)
+        runner.register(passinghook)
+        assert(runner.evaluate() == True)
+        assert(runner.log.read() ==
+               ["warning: veryslowhook timed out after 0.0s"])
+        runner = hookrunner(timeoutpolicy='pass')
+        runner.register(veryslowhook, timeout=0.01)
+        assert(runner.evaluate() == True)
+        assert(runner.log.read() == [])
+        with self.assertRaises(ValueError):
+            hookrunner(timeoutpolicy='retry')
+
+    def test_deadline(self):
+        """Hooks not started before the deadline are not run"""
+        runner = hookrunner(deadline=0.06)
+        runner.register(veryslowhook, blocking=False)
+        runner.register(passinghook)
+        assert(runner.evaluate() == False)
+        assert(runner.log.read() == [
+            "veryslowhook timed out after 0.1s",
+            "passinghook was not run, deadline of 0.1s reached"])
+
+
+class testlogsink(unittest.TestCase):
+    def setUp(self):
+        self.out = StringIO()
+        self.sink = logsink(self.out)
+
+    def test_streaming(self):
+        """Messages are written while the hooks run"""
+        out = self.out
+
+        class streaminghook(basehook):
+            def check(self, log, revdata):
+                log.write(ERROR_MSG)
+                assert(out.getvalue() == ERROR_MSG + "\n")
+                return True
+
+        runner = hookrunner(logsink=self.sink)
+        runner.register(streaminghook)
+        runner.register(failinghook)
+        assert(runner.evaluate() == False)
+        assert(self.out.getvalue() == "%s\n%s\n" % (ERROR_MSG, ERROR_MSG))
+        assert(runner.log.read() == [ERROR_MSG, ERROR_MSG])
+
+    def test_repeats(self):
+        class repeatinghook(basehook):
+            def check(self, log, revdata):
+                for i in range(1000):
+                    log.write(ERROR_MSG)
+                log.write(ERROR_MSG2)
+                log.write(ERROR_MSG2)
+                return False
+
+        runner = hookrunner(logsink=self.sink)
+        runner.register(repeatinghook)
+        runner.evaluate()
+        assert(runner.log.read() == [
+            ERROR_MSG, "(previous message repeated 999 times)",
+            ERROR_MSG2, "(previous message repeated 1 times)"])
+
+    def test_repeats_timeout(self):
+        """The repeats are written for hooks run with a timeout too"""
+        class repeatinghook(basehook):
+            def check(self, log, revdata):
+                for i in range(3):
+                    log.write("same")
+                return True
+
+        runner = hookrunner(logsink=self.sink)
+        runner.register(repeatinghook, timeout=1)
+        assert(runner.evaluate() == True)
+        assert(self.out.getvalue() ==
+               "same\n(previous message repeated 2 times)\n")
+
+    def test_maxbytes(self):
+        """Only maxbytes of messages are kept, all are written"""
+        class verbosehook(basehook):
+            def check(self, log, revdata):
+                for i in range(100):
+                    log.write("message %02d" % i)
+                return False
+
+        sink = logsink(self.out, maxbytes=100)
+        runner = hookrunner(logsink=sink)
+        runner.register(verbosehook)
+        runner.evaluate()
+        assert(len(runner.log.read()) == 10)
+        assert(sink.dropped == 90)
+        assert(len(self.out.getvalue().splitlines()) == 100)
+
+    def test_parallel(self):
+        runner = parallelhookrunner(max_workers=4, logsink=self.sink)
+        for i in range(4):
+            runner.register(slowfailinghook, blocking=False)
+        assert(runner.evaluate() == False)
+        assert(self.out.getvalue() == (ERROR_MSG + "\n") * 4)
+        assert(runner.log.read() == [ERROR_MSG] * 4)
+
+    def test_progress(self):
+        class revs(object):
+            revs = ['a', 'b', 'c']
+
+        class commithook(basecommithook):
+            def checkcommit(self, log, revdata, rev):
+                return True
+
+        sink = logsink(self.out, progress=True)
+        sink.interval = 0
+        runner = hookrunner(logsink=sink, revdata=revs())
+        runner.register(commithook)
+        assert(runner.evaluate() == True)
+        assert("\rchecking commits: 3/3" in self.out.getvalue())
+        sink.close()
+        assert(self.out.getvalue().endswith("\r" + " " * 21 + "\r"))
+
+
+class testprofile(unittest.TestCase):
+    def test_results(self):
+        """Runners record the outcome and cost of each hook"""
+        # with the 'warn' policy, the timeout does not end the run
+        for runner in (hookrunner(timeoutpolicy='warn'),
+                       parallelhookrunner(max_workers=2,
+                                          timeoutpolicy='warn'),
+                       processhookrunner(max_workers=2,
+                                         timeoutpolicy='warn')):
+            runner.register(forkinghook)
+            runner.register(failinghook, blocking=False)
+            runner.register(veryslowhook, timeout=0.01)
+            runner.evaluate()
+            assert([r.status for r in runner.results] ==
+                   ['pass', 'fail', 'timeout'])
+            assert(runner.results[0].forks == 2)
+            assert(runner.results[1].forks == 0)
+            assert(runner.results[2].cpu is None)
+            assert(runner.parseresult.status == 'pass')
+
+    def test_writeprofile(self):
+        runner = hookrunner()
+        runner.register(forkinghook)
+        runner.register(failinghook)
+        runner.register(passinghook)
+        runner.evaluate()
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            writeprofile('update', runner, path)
+            with open(path) as f:
+                lines = [json.loads(l) for l in f]
+        finally:
+            os.unlink(path)
+        assert([(l['hook'], l['status'], l['forks']) for l in lines] ==
+               [('input parsing', 'pass', 0), ('forkinghook', 'pass', 2),
+                ('failinghook', 'fail', 0), ('passinghook', 'not run', 0)])
+        assert(all(l['phase'] == 'update' for l in lines))
+
+        origstderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            writeprofile('update', runner, '1')
+            table = sys.stderr.getvalue().splitlines()
+        finally:
+            sys.stderr = origstderr
+        assert(len(table) == 5)
+        # sorted by wall time, the two forks are the slowest
+        assert(table[1].split()[:2] == ['forkinghook', 'pass'])
+
+
 class testparallelhookrunner(unittest.TestCase):
     def test_speed(self):
         """parallel hook runner should run hooks really in parallel"""
-        runner = parallelhookrunner()
+        runner = parallelhookrunner(max_workers=100)
         for i in range(100):
             runner.register(slowfailinghook)
         t1 = time.time()
@@ -91,10 +325,10 @@ class testparallelhookrunner(unittest.TestCase):
 
     def test_aggregation(self):
         """parallel hook runner should aggregate log of all the failures"""
-        runner = parallelhookrunner()
+        runner = parallelhookrunner(max_workers=4)
         for i in range(3):
-            runner.register(slowfailinghook)
-        runner.register(failinghook2)
+            runner.register(slowfailinghook, blocking=False)
+        runner.register(failinghook2, blocking=False)
         runner.evaluate()
         assert len(runner.log.read()) == 4
         assert ERROR_MSG2 in runner.log.read()
@@ -109,6 +343,313 @@ class testparallelhookrunner(unittest.TestCase):
             runner.register(passinghook)
         assert(runner.evaluate() == False)
 
+    def test_bounded_workers(self):
+        """Hooks are run by at most max_workers reused threads"""
+        threadnames = set()
+
+        class recordinghook(basehook):
+            def check(self, log, revdata):
+                threadnames.add(threading.current_thread().name)
+                time.sleep(0.01)
+                return True
+
+        runner = parallelhookrunner(max_workers=4)
+        for i in range(40):
+            runner.register(recordinghook)
+        t1 = time.time()
+        assert(runner.evaluate() == True)
+        t2 = time.time()
+        assert(len(threadnames) == 4)
+        # 40 * 0.01 = 0.4s if the run was not parallel
+        assert (t2-t1) < 0.3
+
+    def test_commit_fanout(self):
+        """The commits checked by a commit hook are spread over the workers,
+        their logs stay in order"""
+        threadnames = set()
+        prefetched = []
+
+        class revs(object):
+            revs = ['rev%02d' % i for i in range(40)]
+
+            def prefetch(self, revs):
+                prefetched.append(revs)
+
+        class slowcommithook(basecommithook):
+            def checkcommit(self, log, revdata, rev):
+                threadnames.add(threading.current_thread().name)
+                time.sleep(0.01)
+                log.write(rev)
+                return rev != 'rev07'
+
+        runner = parallelhookrunner(max_workers=4, revdata=revs())
+        runner.register(slowcommithook)
+        t1 = time.time()
+        assert(runner.evaluate() == False)
+        t2 = time.time()
+        assert(runner.log.read() == revs.revs)
+        assert(prefetched == [revs.revs])
+        assert(len(threadnames) == 4)
+        # 40 * 0.01 = 0.4s if the commits were checked one by one
+        assert (t2-t1) < 0.3
+        threadnames.clear()
+        slowcommithook.threadsafe = False
+        runner.evaluate()
+        assert(len(threadnames) == 1)
+
+    def test_commit_fanout_profile(self):
+        """The processes started by the workers checking the commits are
+        accounted to the hook"""
+        class revs(object):
+            revs = ['rev%02d' % i for i in range(20)]
+
+        class forkingcommithook(basecommithook):
+            def checkcommit(self, log, revdata, rev):
+                hooklib_util.readcmd(['true'])
+                return True
+
+        runner = parallelhookrunner(max_workers=4, revdata=revs())
+        runner.register(forkingcommithook)
+        assert(runner.evaluate() == True)
+        assert(runner.results[0].forks == 20)
+
+    def test_timeout_frees_worker(self):
+        """A hook that timed out does not keep the hooks queued behind it
+        from running"""
+        runner = parallelhookrunner(max_workers=1)
+        runner.register(veryslowhook, timeout=0.1, blocking=False)
+        runner.register(passinghook, timeout=0.1)
+        t1 = time.time()
+        assert(runner.evaluate() == False)
+        assert (time.time() - t1) < 1
+        assert(runner.results[1].passed == True)
+
+    def test_no_thread_leak(self):
+        before = threading.active_count()
+        for i in range(20):
+            runner = scheduledhookrunner(max_workers=4)
+            for j in range(4):
+                runner.register(passinghook)
+            runner.evaluate()
+        time.sleep(0.05)
+        assert(threading.active_count() <= before + 1)
+
+    def test_runall(self):
+        pool = parallelhookrunner(max_workers=3).pool
+        assert(pool.runall(lambda x: x * 2, list(range(10)), 3) ==
+               [x * 2 for x in range(10)])
+        with self.assertRaises(ZeroDivisionError):
+            pool.runall(lambda x: 1 // x, [1, 0, 2])
+
+    def test_blocking_failure_cancels(self):
+        """A failing blocking hook returns without waiting for the others,
+        which are told to stop"""
+        cancelled = threading.Event()
+
+        class cancellablehook(basehook):
+            def check(self, log, revdata):
+                while not self.cancelled():
+                    time.sleep(0.01)
+                cancelled.set()
+                return True
+
+        runner = parallelhookrunner(max_workers=3)
+        runner.register(cancellablehook)
+        runner.register(slowfailinghook, blocking=False)
+        runner.register(failinghook)
+        t1 = time.time()
+        assert(runner.evaluate() == False)
+        t2 = time.time()
+        assert (t2-t1) < 0.05
+        assert(runner.log.read() == [ERROR_MSG])
+        assert(cancelled.wait(1))
+
+    def test_timeout(self):
+        runner = parallelhookrunner(max_workers=2, timeoutpolicy='warn')
+        runner.register(veryslowhook, timeout=0.06)
+        runner.register(slowfailinghook, blocking=False)
+        t1 = time.time()
+        assert(runner.evaluate() == False)
+        t2 = time.time()
+        assert (t2-t1) < 0.5
+        assert(runner.log.read() == [
+            "warning: veryslowhook timed out after 0.1s", ERROR_MSG])
+
+    def test_deadline(self):
+        """At the deadline, running and queued hooks time out"""
+        runner = parallelhookrunner(max_workers=1, deadline=0.05)
+        runner.register(veryslowhook)
+        runner.register(passinghook)
+        t1 = time.time()
+        assert(runner.evaluate() == False)
+        t2 = time.time()
+        assert (t2-t1) < 0.5
+        assert(runner.log.read() == ["veryslowhook timed out after 0.0s"] or
+               runner.log.read() == ["veryslowhook timed out after 0.1s"])
+
+    def test_crashing_hook(self):
+        """A hook raising an exception fails instead of hanging the run"""
+        class crashinghook(basehook):
+            def check(self, log, revdata):
+                raise KeyError('boom')
+
+        runner = parallelhookrunner(max_workers=2)
+        runner.register(crashinghook)
+        runner.register(passinghook)
+        assert(runner.evaluate() == False)
+        assert(len(runner.log.read()) == 1)
+
+
+def recordinghook(name, passes=True, duration=0, **attrs):
+    """Make a hook appending name to started when it starts"""
+    def check(self, log, revdata):
+        self.started.append(name)
+        time.sleep(duration)
+        if not passes:
+            log.write("%s failed" % name)
+        return passes
+    attrs.update(check=check, started=attrs.get('started', []))
+    return type(name, (basehook, ), attrs)
+
+
+class testscheduledhookrunner(unittest.TestCase):
+    def setUp(self):
+        self.started = []
+
+    def hook(self, name, **kwargs):
+        return recordinghook(name, started=self.started, **kwargs)
+
+    def test_requires(self):
+        a = self.hook('a', duration=0.02)
+        b = self.hook('b', requires=[a])
+        runner = scheduledhookrunner()
+        runner.register(b)
+        runner.register(a)
+        assert(runner.evaluate() == True)
+        assert(self.started == ['a', 'b'])
+
+    def test_gates_first(self):
+        """A failing gate rejects before any scan starts"""
+        scan = self.hook('scan', kind='scan')
+        gate = self.hook('gate', passes=False, kind='gate')
+        runner = scheduledhookrunner()
+        runner.register(scan)
+        runner.register(gate)
+        assert(runner.evaluate() == False)
+        assert(self.started == ['gate'])
+        assert(runner.log.read() == ['gate failed'])
+        assert(runner.results[0].status == 'not run')
+
+    def test_cost_order(self):
+        hooks = [self.hook('h%d' % i, cost=c)
+                 for i, c in enumerate([3, None, 0.01, 1])]
+        runner = scheduledhookrunner(max_workers=1)
+        for h in hooks:
+            runner.register(h)
+        assert(runner.evaluate() == True)
+        assert(self.started == ['h2', 'h3', 'h0', 'h1'])
+
+    def test_failed_requirement(self):
+        a = self.hook('a', passes=False)
+        b = self.hook('b', requires=[a])
+        runner = scheduledhookrunner()
+        runner.register(a, blocking=False)
+        runner.register(b)
+        assert(runner.evaluate() == False)
+        assert(self.started == ['a'])
+        assert([r.status for r in runner.results] == ['fail', 'not run'])
+
+    def test_parallel_branches(self):
+        runner = scheduledhookrunner(max_workers=4)
+        for i in range(4):
+            runner.register(self.hook('h%d' % i, duration=0.06))
+        t1 = time.time()
+        assert(runner.evaluate() == True)
+        assert(time.time() - t1 < 0.11)
+
+    def test_invalid(self):
+        a = self.hook('a')
+        b = self.hook('b', requires=[a])
+        runner = scheduledhookrunner()
+        runner.register(b)
+        with self.assertRaises(ValueError):
+            runner.evaluate()
+        a.requires = [b]
+        runner.register(a)
+        with self.assertRaises(ValueError):
+            runner.evaluate()
+
+    def test_timings(self):
+        """Measured costs override the declared ones"""
+        path = os.path.join(tempfile.mkdtemp(), 'timings.json')
+        try:
+            slow = self.hook('slow', cost=0.01, duration=0.06)
+            fast = self.hook('fast', cost=1)
+            for i in range(2):
+                del self.started[:]
+                runner = scheduledhookrunner(max_workers=1, timings=path)
+                runner.register(slow)
+                runner.register(fast)
+                assert(runner.evaluate() == True)
+            assert(self.started == ['fast', 'slow'])
+            assert(hooktimings(path).estimate(slow) > 0.05)
+        finally:
+            shutil.rmtree(os.path.dirname(path))
+
+
+class testprocesshookrunner(unittest.TestCase):
+    def test_logs_in_registration_order(self):
+        """Logs of the worker processes are merged in registration order"""
+        runner = processhookrunner(max_workers=3)
+        runner.register(slowfailinghook, blocking=False)
+        runner.register(cpuboundhook)
+        runner.register(failinghook2, blocking=False)
+        runner.register(passinghook)
+        assert(runner.evaluate() == False)
+        assert(runner.log.read() == [ERROR_MSG, "pid %d" % 4999950000,
+                                     ERROR_MSG2])
+
+    def test_blocking_failure(self):
+        """Worker processes still running are stopped on blocking failure"""
+        runner = processhookrunner(max_workers=2)
+        runner.register(veryslowhook)
+        runner.register(failinghook)
+        t1 = time.time()
+        assert(runner.evaluate() == False)
+        t2 = time.time()
+        assert (t2-t1) < 0.5
+        assert(runner.log.read() == [ERROR_MSG])
+
+    def test_passing(self):
+        runner = processhookrunner(max_workers=2)
+        runner.register(cpuboundhook)
+        runner.register(passinghook)
+        assert(runner.evaluate() == True)
+
+    def test_timeout_frees_process(self):
+        """A hook that timed out does not keep the hooks queued behind it
+        from running, its process is replaced"""
+        runner = processhookrunner(max_workers=1)
+        runner.register(veryslowhook, timeout=0.3, blocking=False)
+        runner.register(passinghook, timeout=1)
+        t1 = time.time()
+        assert(runner.evaluate() == False)
+        assert (time.time() - t1) < 2
+        assert([r.status for r in runner.results] == ['timeout', 'pass'])
+
+    def test_commit_fanout(self):
+        """The commits of a commit hook are spread over the processes,
+        their logs stay in order"""
+        runner = processhookrunner(max_workers=2, revdata=commitrevs())
+        runner.register(pidcommithook)
+        assert(runner.evaluate() == False)
+        logs = [m.split() for m in runner.log.read()]
+        assert([rev for rev, pid in logs] == commitrevs.revs)
+        pids = set(int(pid) for rev, pid in logs)
+        assert(os.getpid() not in pids)
+        # a chunk of 10 commits keeps its process busy for 0.1s
+        assert(len(pids) == 2)
+
 
 class testscmresolution(unittest.TestCase):
     """Checking that we get the right SCM parser for different hook type"""
@@ -116,10 +657,13 @@ class testscmresolution(unittest.TestCase):
     def setUp(self):
         self.origargv = list(sys.argv)
         self.origenv = os.environ.copy()
+        self.origreadlines = hooklib_input.readlines
 
     def tearDown(self):
-        os.environ = self.origenv
+        os.environ.clear()
+        os.environ.update(self.origenv)
         sys.argv = self.origargv
+        hooklib_input.readlines = self.origreadlines
 
     def test_git_postupdate(self):
         os.environ["GIT_DIR"] = "."
@@ -140,6 +684,17 @@ class testscmresolution(unittest.TestCase):
         assert(revdata.old == "0"*40)
         assert(revdata.new == "1"*40)
 
+    def test_git_postreceive(self):
+        os.environ["GIT_DIR"] = "."
+        hooklib_input.readlines = lambda: ["%s %s refs/heads/master\n" %
+                                           ("0"*40, "1"*40)]
+        revdata = inputparser.fromphase('post-receive').parse()
+        assert(revdata.receivedrevs == (("0"*40, "1"*40,
+                                         "refs/heads/master"),))
+        # only the fields of the phase are public
+        assert([k for k in vars(revdata) if not k.startswith('_')] ==
+               ['receivedrevs'])
+
     def test_hg_update(self):
         os.environ["HG_NODE"] = "a"*40
         revdata = inputparser.fromphase('update').parse()
@@ -275,6 +830,35 @@ class testscmresolution(unittest.TestCase):
         revdata = inputparser.fromphase('post-receive').parse()
         assert(revdata.receivedrevs == revs)
 
+    def test_refupdate(self):
+        update = refupdate('a'*40, '0'*40, 'refs/heads/master')
+        old, new, ref = update
+        assert((old, new, ref) == ('a'*40, '0'*40, 'refs/heads/master'))
+        assert(update.new == new and update[2] == ref)
+        assert(update != ('a'*40, 'b'*40, 'refs/heads/master'))
+        assert(pickle.loads(pickle.dumps(update)) == update)
+        push = pushupdate('refs/heads/a', 'a'*40, 'refs/heads/b', 'b'*40)
+        assert(push.remotesha == 'b'*40)
+        assert(not hasattr(update, '__dict__'))
+
+    def test_shalist(self):
+        shas = ['%040x' % i for i in range(1000)]
+        revs = shalist(shas)
+        assert(revs == shas and shas == revs)
+        assert(revs != shas[1:])
+        assert(len(revs) == 1000 and revs[-1] == shas[-1])
+        assert(revs[10:0:-2] == shas[10:0:-2])
+        assert(isinstance(revs[:2], shalist))
+        assert(shas[500] in revs and 'f'*40 not in revs and 'HEAD' not in revs)
+        revs.append('f'*40)
+        assert('f'*40 in revs)
+        assert(pickle.loads(pickle.dumps(revs)) == revs)
+        with self.assertRaises(IndexError):
+            revs[1001]
+        with self.assertRaises(ValueError):
+            revs.append('abcd')
+        assert(len(revs.data) == 1001 * 20)
+
     def test_gitprepush(self):
         revs = (('refs/heads/master', 'a'*40, 'refs/heads/foreign', 'b'*40),
                 ('refs/heads/master', 'a'*40, 'refs/heads/foreign', '0'*40))
@@ -287,5 +871,1073 @@ class testscmresolution(unittest.TestCase):
     # TODO add documentation for what is available for each kind of hooks
     # see https://git-scm.com/docs/githooks
 
+class gitrepotestcase(unittest.TestCase):
+    """Run tests in a small throwaway git repo"""
+
+    def setUp(self):
+        self.origcwd = os.getcwd()
+        self.origenv = os.environ.copy()
+        self.repo = tempfile.mkdtemp()
+        os.chdir(self.repo)
+        for k in ('NAME', 'EMAIL'):
+            os.environ['GIT_AUTHOR_%s' % k] = 'hooklib'
+            os.environ['GIT_COMMITTER_%s' % k] = 'hooklib'
+        self.git('init', '-q')
+        self.commits = [self.commit('message %d\n\nbody %d' % (i, i))
+                        for i in range(3)]
+
+    def tearDown(self):
+        os.chdir(self.origcwd)
+        os.environ.clear()
+        os.environ.update(self.origenv)
+        shutil.rmtree(self.repo)
+
+    def git(self, *args):
+        return hooklib_util.tostr(subprocess.check_output(('git', ) + args))\
+                          .strip()
+
+    def commit(self, msg):
+        self.git('commit', '-q', '--allow-empty', '-m', msg)
+        return self.git('rev-parse', 'HEAD')
+
+    def committree(self, parent, msg):
+        """Create a commit without updating any ref"""
+        return self.git('commit-tree', '-p', parent, '-m', msg,
+                        '%s^{tree}' % parent)
+
+
+class testcachedproperty(unittest.TestCase):
+    def test_fields_not_serialized(self):
+        """A slow field does not delay the first read of the others"""
+        started = threading.Event()
+        release = threading.Event()
+
+        class data(object):
+            @hooklib_util.cachedproperty
+            def slow(self):
+                started.set()
+                release.wait(5)
+                return 1
+
+            @hooklib_util.cachedproperty
+            def fast(self):
+                return 2
+
+        d = data()
+        t = threading.Thread(target=lambda: d.slow)
+        t.start()
+        try:
+            started.wait(5)
+            t1 = time.time()
+            assert(d.fast == 2)
+            assert(time.time() - t1 < 1)
+        finally:
+            release.set()
+            t.join()
+        assert(d.slow == 1)
+
+
+class testartifactmemo(unittest.TestCase):
+    def test_single_flight(self):
+        memo = hooklib_util.artifactmemo()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            time.sleep(0.05)
+            return [1, 2, 3]
+        values = []
+        threads = [threading.Thread(
+                       target=lambda: values.append(memo.get('k', compute)))
+                   for i in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert(len(calls) == 1)
+        assert(values == [[1, 2, 3]] * 20)
+        assert(all(v is values[0] for v in values))
+
+    def test_budget(self):
+        value = 'x' * 1000
+        memo = hooklib_util.artifactmemo(budget=3 * hooklib_util.sizeof(value))
+        calls = []
+
+        def compute(i):
+            calls.append(i)
+            return value
+        for i in [0, 1, 2, 0, 3, 0, 1]:
+            memo.get(i, lambda: compute(i))
+        # 1 was the least recently used when 3 came in
+        assert(calls == [0, 1, 2, 3, 1])
+        assert(memo.size <= memo.budget)
+        memo.get('big', lambda: 'x' * 10000)
+        assert('big' not in memo.values)
+
+    def test_failure(self):
+        memo = hooklib_util.artifactmemo()
+
+        def fail():
+            raise ValueError('boom')
+        with self.assertRaises(ValueError):
+            memo.get('k', fail)
+        assert(memo.get('k', lambda: 1) == 1)
+
+    def test_resolver(self):
+        resolver = gitinforesolver()
+        assert(resolver.memo('k', lambda: 1) == 1)
+        assert(resolver.memo('k', lambda: 2) == 1)
+        copy = pickle.loads(pickle.dumps(resolver))
+        assert(copy.memo('k', lambda: 2) == 2)
+
+
+class testgitodb(gitrepotestcase):
+    backendname = 'python'
+
+    def setUp(self):
+        super(testgitodb, self).setUp()
+        self.git('gc', '-q')
+        # a loose commit on top of the packed ones
+        self.commits.append(self.commit('message 3\n\nbody 3'))
+        self.git('tag', '-a', '-m', 'tag', 'v1', self.commits[1])
+        self.backend = hooklib_gitodb.openbackend(self.backendname)
+        # counts the processes started by the backend
+        self.stopwatch = hooklib_util.stopwatch()
+
+    def tearDown(self):
+        self.backend.close()
+        super(testgitodb, self).tearDown()
+
+    def test_no_fork(self):
+        """Packed and loose objects are read without starting git"""
+        names = self.commits + ['%s^{commit}' % c for c in self.commits]
+        with self.stopwatch:
+            objs = self.backend.read(names)
+        assert(self.stopwatch.forks == 0)
+        catfile = gitcatfilebatch()
+        try:
+            assert(objs == catfile.read(names))
+        finally:
+            catfile.close()
+        assert(objs[0][0] == 'commit')
+
+    def test_peel_tag(self):
+        tag = self.git('rev-parse', 'v1')
+        objs = self.backend.read([tag, tag + '^{commit}'])
+        assert(objs[0][0] == 'tag')
+        assert(objs[1] == self.backend.read([self.commits[1]])[0])
+
+    def test_scan_while_reading(self):
+        """Packs found by a thread do not break the reads of the others"""
+        self.backend.read(self.commits)
+        self.commit('message 4')
+        self.git('repack', '-q')
+        pack = [p for p in self.backend.packs.values() if p is not None][0]
+        find = pack.find
+
+        def scanningfind(binsha):
+            # another thread scanning while this one looks the sha up
+            self.backend.scanpacks()
+            return find(binsha)
+        pack.find = scanningfind
+        assert(self.backend.readsha('f' * 40) is None)
+        assert(len(self.backend.packs) == 2)
+
+    def test_fallback(self):
+        """Names that are not shas and missing objects are left to git"""
+        with self.stopwatch:
+            objs = self.backend.read(['HEAD^{commit}', 'f' * 40])
+        assert(objs == [self.backend.read([self.commits[-1]])[0], None])
+        assert(self.stopwatch.forks == 1)
+
+    def test_quarantine(self):
+        """Objects of a push waiting in quarantine are visible"""
+        quarantine = os.path.join(self.repo, '.git', 'objects', 'incoming')
+        os.mkdir(quarantine)
+        os.environ['GIT_OBJECT_DIRECTORY'] = quarantine
+        os.environ['GIT_ALTERNATE_OBJECT_DIRECTORIES'] = \
+            os.path.join(self.repo, '.git', 'objects')
+        new = self.committree(self.commits[-1], 'message 4')
+        assert(os.listdir(quarantine))
+        os.environ['HOOKLIB_GIT_BACKEND'] = self.backendname
+        resolver = gitinforesolver()
+        try:
+            with self.stopwatch:
+                assert(resolver.commitmessagesfor([self.commits[0], new]) ==
+                       ['message 0\n\nbody 0', 'message 4'])
+            assert(self.stopwatch.forks == 0)
+        finally:
+            resolver.close()
+
+    def test_select(self):
+        os.environ['HOOKLIB_GIT_BACKEND'] = 'subprocess'
+        assert(isinstance(hooklib_gitodb.openbackend(), gitcatfilebatch))
+        os.environ['HOOKLIB_GIT_BACKEND'] = 'python'
+        assert(isinstance(hooklib_gitodb.openbackend(),
+                          hooklib_gitodb.pythonbackend))
+        with self.assertRaises(ValueError):
+            hooklib_gitodb.openbackend('svn')
+
+
+try:
+    import pygit2
+except ImportError:
+    pygit2 = None
+
+
+@unittest.skipIf(pygit2 is None, "pygit2 is not installed")
+class testpygit2backend(testgitodb):
+    """The backend picked by default when pygit2 is installed"""
+    backendname = 'pygit2'
+
+    def test_scan_while_reading(self):
+        self.skipTest('libgit2 finds the packs itself')
+
+    def test_auto(self):
+        backend = hooklib_gitodb.openbackend('auto')
+        try:
+            assert(isinstance(backend, hooklib_gitodb.pygit2backend))
+        finally:
+            backend.close()
+
+
+class wipcommithook(basecommithook):
+    checked = []
+
+    def checkcommit(self, log, revdata, rev):
+        wipcommithook.checked.append(rev)
+        if revdata.commitmessagefor(rev).startswith('WIP'):
+            log.write("%s is a work in progress" % rev)
+            return False
+        return True
+
+
+class testverdictcache(gitrepotestcase):
+    def setUp(self):
+        super(testverdictcache, self).setUp()
+        self.commits.append(self.commit('WIP message 3'))
+        wipcommithook.checked = []
+
+    def runhook(self, cache, runnerclass=hookrunner):
+        runner = runnerclass(cache=cache)
+        runner.revdata = gitinforesolver()
+        runner.revdata.setrevs(self.commits)
+        runner.register(wipcommithook)
+        try:
+            return runner.evaluate(), runner.log.read()
+        finally:
+            runner.revdata.close()
+
+    def test_no_cache(self):
+        assert(self.runhook(None) ==
+               (False, ['%s is a work in progress' % self.commits[3]]))
+        assert(self.runhook(None)[0] == False)
+        assert(wipcommithook.checked == self.commits * 2)
+
+    def test_cached_verdicts(self):
+        """Passes are skipped and failures replayed on the next run"""
+        path = os.path.join(self.repo, '.git', 'verdicts.sqlite')
+        first = self.runhook(verdictcache(path))
+        assert(first[0] == False)
+        assert(wipcommithook.checked == self.commits)
+        self.commits.append(self.commit('message 4'))
+        assert(self.runhook(verdictcache(path)) == first)
+        assert(wipcommithook.checked == self.commits)
+
+    def test_default_path(self):
+        verdictcache().flush()
+        assert(os.path.exists(os.path.join(self.repo, '.git',
+                                           'hooklib-verdicts.sqlite')))
+
+    def test_version(self):
+        path = os.path.join(self.repo, 'verdicts.sqlite')
+        self.runhook(verdictcache(path))
+        wipcommithook.version = 2
+        try:
+            self.runhook(verdictcache(path))
+        finally:
+            wipcommithook.version = None
+        assert(wipcommithook.checked == self.commits * 2)
+
+    def test_eviction(self):
+        path = os.path.join(self.repo, 'verdicts.sqlite')
+        self.runhook(verdictcache(path, maxentries=3))
+        wipcommithook.checked = []
+        self.runhook(verdictcache(path, maxentries=3))
+        assert(len(wipcommithook.checked) == 1)
+
+    def test_processes(self):
+        path = os.path.join(self.repo, 'verdicts.sqlite')
+        self.runhook(verdictcache(path), processhookrunner)
+        self.runhook(verdictcache(path))
+        assert(wipcommithook.checked == [])
+
+
+try:
+    import mercurial.hg
+    import mercurial.ui
+except ImportError:
+    mercurial = None
+HG = os.path.join(os.path.dirname(sys.executable), 'hg')
+
+
+@unittest.skipIf(mercurial is None or not os.path.exists(HG),
+                 "mercurial is not installed")
+class testhginforesolver(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # the tests only read the repo, hg is too slow to start to create
+        # it for each of them
+        cls.repo = tempfile.mkdtemp()
+        cls.hg('init', cls.repo)
+        for i in range(3):
+            with open(os.path.join(cls.repo, 'f%d' % i), 'w') as f:
+                f.write('%d' % i)
+            cls.hg('commit', '-R', cls.repo, '-u', 'hooklib', '-A',
+                   '-m', 'message %d' % i)
+        cls.nodes = cls.hg('log', '-R', cls.repo, '-r', '0:2',
+                           '-T', '{node}\n').split()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.repo)
+
+    def setUp(self):
+        self.origcwd = os.getcwd()
+        self.origenv = os.environ.copy()
+        os.chdir(self.repo)
+        os.environ['PATH'] = os.path.dirname(HG) + os.pathsep + \
+            os.environ['PATH']
+
+    def tearDown(self):
+        os.chdir(self.origcwd)
+        os.environ.clear()
+        os.environ.update(self.origenv)
+
+    @staticmethod
+    def hg(*args):
+        return hooklib_util.tostr(subprocess.check_output((HG, ) + args))
+
+    def repository(self):
+        # mercurial paths are bytes
+        return mercurial.hg.repository(mercurial.ui.ui(),
+                                       hooklib_util.tobytes(self.repo))
+
+    def check(self, resolver):
+        assert(resolver.revs == self.nodes[1:])
+        assert(resolver.commitmessagesfor(resolver.revs) ==
+               ['message 1', 'message 2'])
+        assert(resolver.authorfor(self.nodes[2]) == 'hooklib')
+        assert(resolver.filesfor(self.nodes[2]) == ['f2'])
+        # outside of revs
+        assert(resolver.commitmessagefor(self.nodes[0]) == 'message 0')
+
+    def test_range(self):
+        os.environ['HG_NODE'] = self.nodes[1]
+        os.environ['HG_NODE_LAST'] = self.nodes[2]
+        resolver = inputparser.fromphase('update').parse()
+        sw = hooklib_util.stopwatch()
+        with sw:
+            self.check(resolver)
+        assert(sw.forks == 2)
+
+    def test_inprocess(self):
+        repo = self.repository()
+        resolver = hgrepoinforesolver(repo, self.nodes[1], self.nodes[2])
+        sw = hooklib_util.stopwatch()
+        with sw:
+            self.check(resolver)
+        assert(sw.forks == 0)
+        assert(resolver.reporoot == self.repo)
+
+    def test_hghook(self):
+        repo = self.repository()
+        ui = MagicMock()
+        hook = hghook([passinghook, failinghook])
+        assert(hook(ui, repo, 'pretxnchangegroup', node=self.nodes[1],
+                    node_last=self.nodes[2]) == True)
+        ui.warn.assert_called_once_with(hooklib_util.tobytes(ERROR_MSG +
+                                                             '\n'))
+        assert(hghook([passinghook])(ui, repo, 'pretxnchangegroup',
+                                     node=self.nodes[1]) == False)
+        # hooks like precommit are not given a node
+        assert(hghook([passinghook])(ui, repo, 'pretxnchangegroup') == False)
+
+
+class testgitinforesolver(gitrepotestcase):
+
+    def test_commitmessagefor(self):
+        resolver = gitinforesolver()
+        assert(resolver.commitmessagefor(self.commits[0]) ==
+               'message 0\n\nbody 0')
+        assert(resolver.commitmessagefor('HEAD') == 'message 2\n\nbody 2')
+        resolver.close()
+
+    def test_commitmessagesfor(self):
+        resolver = gitinforesolver()
+        msgs = resolver.commitmessagesfor(self.commits * 1000)
+        assert(len(msgs) == 3000)
+        assert(msgs[:3] == ['message %d\n\nbody %d' % (i, i)
+                            for i in range(3)])
+        with self.assertRaises(ValueError):
+            resolver.commitmessagefor('f'*40)
+        resolver.close()
+
+    def test_blobs(self):
+        with open('small', 'w') as f:
+            f.write('small\n')
+        with open('large', 'w') as f:
+            f.write('x' * 100000)
+        self.git('add', 'small', 'large')
+        c = self.commit('add files')
+        resolver = gitinforesolver()
+        assert(resolver.blobfor(c, 'small') == b'small\n')
+        assert(resolver.blobfor('HEAD', 'missing') is None)
+        pairs = [(c, 'large'), (c, 'small'), (c, 'nope'), (self.commits[0],
+                                                          'small')]
+        assert(resolver.blobsizesfor(pairs) == [100000, 6, None, None])
+        assert(resolver.blobsfor(pairs) == [b'x' * 100000, b'small\n',
+                                            None, None])
+        assert(resolver.blobsfor(pairs, maxsize=1000) == [None, b'small\n',
+                                                          None, None])
+        resolver.close()
+
+    def test_iterblobs(self):
+        with open('large', 'w') as f:
+            f.write('x' * 100000)
+        self.git('add', 'large')
+        c = self.commit('add large')
+        resolver = gitinforesolver()
+        pairs = [(c, 'large'), (c, 'nope'), (c, 'large')]
+        blobs = list(resolver.iterblobs(pairs, maxsize=200000,
+                                        streamsize=1000))
+        assert([pair for pair, _ in blobs] == pairs)
+        assert(blobs[1][1] is None)
+        stream = blobs[0][1]
+        # left unread, skipped when the next answer was read
+        assert(stream.size == 100000 and stream.left == 0)
+        for pair, blob in resolver.iterblobs(pairs, streamsize=1000):
+            assert(b''.join(blob) == b'x' * 100000)
+            assert(blob.left == 0)
+            break
+        # the answers not read were skipped
+        assert(resolver.blobfor(c, 'large') == b'x' * 100000)
+        assert(list(resolver.iterblobs(pairs, maxsize=10)) ==
+               [(pair, None) for pair in pairs])
+        # the resolver is usable while iterating
+        for pair, blob in resolver.iterblobs(pairs, streamsize=1000):
+            assert(resolver.blobfor(c, 'large') == b'x' * 100000)
+            assert(resolver.commitmessagefor('HEAD') == 'add large')
+        resolver.close()
+
+    def test_staged(self):
+        for name in ('a', 'b', 'c', 'empty'):
+            with open(name, 'w') as f:
+                f.write('' if name == 'empty' else name + '\n')
+        self.git('add', 'a', 'b')
+        self.commit('add a and b')
+        with open('a', 'w') as f:
+            f.write('staged\n')
+        self.git('add', 'a', 'c', 'empty')
+        self.git('rm', '-q', 'b')
+        with open('c', 'w') as f:
+            f.write('not staged\n')
+        os.environ['GIT_DIR'] = '.git'
+        resolver = inputparser.fromphase('pre-commit').parse()
+        assert([(c.status, c.path) for c in resolver.stagedfiles] ==
+               [('M', 'a'), ('D', 'b'), ('A', 'c'), ('A', 'empty')])
+        assert(resolver.unstagedpaths == set(['c']))
+        paths = ['a', 'b', 'c', 'empty', 'untracked']
+        assert(resolver.stagedblobsfor(paths) ==
+               [b'staged\n', None, b'c\n', b'', None])
+        # small files are read, not mapped
+        assert(resolver.stagedblobsfor(paths, mapworktree=True) ==
+               [b'staged\n', None, b'c\n', b'', None])
+        resolver.mapminsize = 0
+        blobs = resolver.stagedblobsfor(paths, mapworktree=True)
+        assert(blobs[0][:] == b'staged\n')
+        assert(not isinstance(blobs[0], bytes))
+        assert(blobs[1:] == [None, b'c\n', b'', None])
+        blobs[0].close()
+        resolver.mapmax = 0
+        assert(isinstance(resolver.stagedblobsfor(['a'], True)[0], bytes))
+        resolver.close()
+
+    def test_staged_many(self):
+        """Mapping the files of a large commit does not run out of file
+        descriptors"""
+        import resource
+        if not os.path.isdir('/proc/self/fd'):
+            self.skipTest('cannot count the open files')
+        for i in range(300):
+            with open('f%d' % i, 'w') as f:
+                f.write('%d\n' % i)
+        self.git('add', '.')
+        os.environ['GIT_DIR'] = '.git'
+        resolver = inputparser.fromphase('pre-commit').parse()
+        resolver.mapminsize = 0
+        paths = ['f%d' % i for i in range(300)]
+        resolver.stagedfiles
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        used = len(os.listdir('/proc/self/fd'))
+        resource.setrlimit(resource.RLIMIT_NOFILE, (used + 100, hard))
+        try:
+            blobs = resolver.stagedblobsfor(paths, mapworktree=True)
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+        assert([b[:] for b in blobs] ==
+               [b'%d\n' % i for i in range(300)])
+        resolver.close()
+
+    def test_prefetch(self):
+        resolver = gitinforesolver()
+        resolver.prefetch(self.commits)
+        resolver._objects.read = MagicMock()
+        assert(resolver.commitmessagefor(self.commits[1]) ==
+               'message 1\n\nbody 1')
+        assert(resolver._objects.read.call_count == 0)
+        resolver.close()
+
+    def test_fields_computed_once(self):
+        """200 threads reading head fork a single git process"""
+        resolver = gitinforesolver()
+        origpopen = hooklib_util.popen
+        hooklib_util.popen = MagicMock(side_effect=origpopen)
+        try:
+            heads = []
+            threads = [threading.Thread(
+                           target=lambda: heads.append(resolver.head))
+                       for i in range(200)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            assert(heads == [self.commits[-1]] * 200)
+            assert(hooklib_util.popen.call_count == 1)
+        finally:
+            hooklib_util.popen = origpopen
+
+    def test_pickle(self):
+        """Resolvers can be sent to the workers of processhookrunner"""
+        resolver = gitinforesolver()
+        resolver.setrevs(self.commits)
+        resolver.head
+        copy = pickle.loads(pickle.dumps(resolver))
+        assert(copy.revs == self.commits)
+        assert(copy.head == self.commits[-1])
+        assert(copy.commitmessagefor(self.commits[0]) ==
+               'message 0\n\nbody 0')
+        copy.close()
+
+    def test_iterrevs(self):
+        resolver = gitinforesolver()
+        resolver.old, resolver.new = self.commits[0], self.commits[2]
+        assert(list(resolver.iterrevs()) == self.commits[:0:-1])
+        assert(list(resolver.iterrevs(batch=1)) ==
+               [[self.commits[2]], [self.commits[1]]])
+        # stopping early does not leave git running
+        it = resolver.iterrevs()
+        assert(next(it) == self.commits[2])
+        it.close()
+        assert('revs' not in resolver.__dict__)
+        resolver.setrevs(self.commits)
+        assert(list(resolver.iterrevs(batch=2)) ==
+               [self.commits[:2], self.commits[2:]])
+
+    def test_newrevs(self):
+        """New commits of a push are computed once across refs"""
+        c0, c1, c2 = self.commits
+        self.git('branch', 'stable', c1)
+        n1 = self.committree(c2, 'n1')
+        n2 = self.committree(n1, 'n2')
+        zero = '0'*40
+        received = ((c2, n1, 'refs/heads/master'),
+                    (zero, n2, 'refs/heads/feature'),
+                    (c1, zero, 'refs/heads/stable'),
+                    (zero, c1, 'refs/heads/copy'))
+        byref = {'refs/heads/master': [n1],
+                 'refs/heads/feature': sorted([n1, n2]),
+                 'refs/heads/stable': [], 'refs/heads/copy': []}
+        resolver = gitinforesolver()
+        resolver.receivedrevs = received
+        # commits made within the same second can be listed in any order
+        assert(sorted(resolver.newrevs) == sorted([n1, n2]))
+        assert(resolver.revs == resolver.newrevs)
+        assert(n2 in resolver.revs and c2 not in resolver.revs)
+        assert(dict((k, sorted(v)) for k, v in
+                    resolver.newrevsbyref.items()) == byref)
+
+        # post-receive, the refs already moved
+        self.git('update-ref', 'refs/heads/master', n1)
+        self.git('update-ref', 'refs/heads/feature', n2)
+        self.git('update-ref', '-d', 'refs/heads/stable')
+        self.git('update-ref', 'refs/heads/copy', c1)
+        resolver = gitinforesolver(refsupdated=True)
+        resolver.receivedrevs = received
+        assert(sorted(resolver.newrevs) == sorted([n1, n2]))
+        assert(dict((k, sorted(v)) for k, v in
+                    resolver.newrevsbyref.items()) == byref)
+
+    def test_newrevs_memory(self):
+        """The new commits of a push take about 20 bytes each, their
+        parents are only read for newrevsbyref"""
+        try:
+            import tracemalloc
+        except ImportError:
+            return
+        stream = ''.join('commit refs/heads/big\nmark :%d\ncommitter h <h> '
+                         '0 +0000\ndata 1\n%d\nfrom :%d\n' % (i, i % 10, i - 1)
+                         if i > 1 else 'commit refs/heads/big\nmark :1\n'
+                         'committer h <h> 0 +0000\ndata 1\n1\nfrom %s\n'
+                         % self.commits[2] for i in range(1, 1001))
+        proc = subprocess.Popen(['git', 'fast-import', '--quiet'],
+                                stdin=subprocess.PIPE)
+        proc.communicate(stream.encode('ascii'))
+        tip = self.git('rev-parse', 'big')
+        self.git('update-ref', '-d', 'refs/heads/big')
+        resolver = gitinforesolver()
+        resolver.receivedrevs = ((self.commits[2], tip, 'refs/heads/big'), )
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            assert(len(resolver.newrevs) == 1000)
+            size = tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+        assert('_parents' not in resolver.__dict__)
+        assert(size < 30 * 1000)
+        assert(len(resolver.newrevsbyref['refs/heads/big']) == 1000)
+
+    def test_update_created_deleted_ref(self):
+        n1 = self.committree(self.commits[2], 'n1')
+        resolver = gitinforesolver()
+        resolver.old, resolver.new = '0'*40, n1
+        assert(resolver.revs == [n1])
+        resolver = gitinforesolver()
+        resolver.old, resolver.new = self.commits[2], '0'*40
+        assert(resolver.revs == [])
+
+    def test_changedfiles(self):
+        with open('a', 'w') as f:
+            f.write('a')
+        os.mkdir('d')
+        with open(os.path.join('d', 'b'), 'w') as f:
+            f.write('b')
+        self.git('add', 'a', 'd')
+        c1 = self.commit('add files')
+        os.chmod('a', 0o755)
+        self.git('rm', '-q', os.path.join('d', 'b'))
+        self.git('add', 'a')
+        c2 = self.commit('chmod and delete')
+        resolver = gitinforesolver()
+        added = resolver.changedfilesfor(c1)
+        assert([(c.status, c.path, c.newmode) for c in added] ==
+               [('A', 'a', '100644'), ('A', 'd/b', '100644')])
+        assert(added[0].oldsha == '0'*40)
+        assert(resolver.changedfilesfor_many([c2, self.commits[0], 'HEAD']) ==
+               [resolver.changedfilesfor(c2), [],
+                resolver.changedfilesfor(c2)])
+        assert([(c.status, c.path, c.oldmode, c.newmode) for c in
+                resolver.changedfilesfor(c2)] ==
+               [('M', 'a', '100644', '100755'),
+                ('D', 'd/b', '100644', '000000')])
+        resolver.setrevs([c1, c2])
+        assert(resolver.changedfiles == ['a', 'd/b'])
+        # many commits, one diff-tree process
+        assert(len(resolver.changedfilesfor_many([c1, c2] * 2000)) == 4000)
+        resolver.close()
+
+    def test_revs(self):
+        resolver = gitinforesolver()
+        resolver.old, resolver.new = self.commits[0], self.commits[2]
+        assert(resolver.revs == self.commits[:0:-1])
+        resolver = gitinforesolver()
+        resolver.setrevs([])
+        # an empty list is a valid value, not a cache miss
+        assert(resolver.revs == [])
+
+
+COLDSTART_HOOK = """
+import time
+start = time.time()
+import sys
+from hooklib import basehook, runhooks
+class coldstarthook(basehook):
+    def check(self, log, revdata):
+        log.write('%f' % (time.time() - start))
+        log.write(','.join(m for m in sys.modules
+                           if m.startswith('mercurial') or m == 'hooklib_hg'))
+        return True
+runhooks('commit-msg', hooks=[coldstarthook])
+"""
+
+
+class testcoldstart(unittest.TestCase):
+    def test_git_hook_coldstart(self):
+        """A git hook reaches check() within its 30ms budget without
+        importing mercurial or the hg backend"""
+        here = os.path.dirname(os.path.abspath(__file__))
+        env = dict(os.environ, PYTHONPATH=here)
+        proc = subprocess.Popen([sys.executable, '-c', COLDSTART_HOOK,
+                                 'messagefile'],
+                                stderr=subprocess.PIPE, env=env)
+        out = hooklib_util.tostr(proc.communicate()[1])
+        elapsed, hgmodules = out.split('\n')[:2]
+        assert(hgmodules == '')
+        assert(float(elapsed) < 0.03)
+
+
+class newrevshook(basehook):
+    def check(self, log, revdata):
+        print("checking %d revisions" % len(revdata.newrevs))
+        log.write(",".join(revdata.newrevs))
+        return True
+
+
+class spooledhook(basehook):
+    runs = []
+
+    def check(self, log, revdata):
+        spooledhook.runs.append([tuple(u) for u in revdata.receivedrevs])
+        return True
+
+
+class raisinghook(basehook):
+    def check(self, log, revdata):
+        raise ValueError('broken hook')
+
+
+class flakyhook(basehook):
+    failures = 0
+
+    def check(self, log, revdata):
+        if flakyhook.failures:
+            flakyhook.failures -= 1
+            log.write(ERROR_MSG)
+            return False
+        return True
+
+
+DETACHED_HOOK = """
+import os, time
+from hooklib import basehook, runhooks
+
+class slownotification(basehook):
+    def check(self, log, revdata):
+        time.sleep(0.5)
+        with open('notified', 'w') as f:
+            f.write(' '.join(revdata.receivedrevs[0]))
+        return True
+
+runhooks('post-receive', hooks=[slownotification], detached=True)
+"""
+
+
+class testspool(gitrepotestcase):
+    def setUp(self):
+        super(testspool, self).setUp()
+        self.spool = os.path.join(self.repo, '.git', 'hooklib-spool',
+                                  'post-receive')
+        spooledhook.runs = []
+
+    def test_coalesce(self):
+        zero = '0'*40
+        entries = [{'receivedrevs': [['a', 'b', 'master'], [zero, 'c', 'x']]},
+                   {'receivedrevs': [['b', 'd', 'master'], ['c', zero, 'x']]},
+                   {'receivedrevs': [['e', 'f', 'stable']]}]
+        assert(hooklib_spool.coalesce(entries) ==
+               [('a', 'd', 'master'), ('e', 'f', 'stable')])
+        assert(hooklib_spool.coalescerevs([{'revs': ['a', 'b']},
+                                           {'revs': ['b', 'c']}]) ==
+               ['a', 'b', 'c'])
+
+    def test_drain(self):
+        """The pushes waiting in the spool are run together"""
+        c0, c1, c2 = self.commits
+        hooklib_spool.enqueue(self.spool, {'receivedrevs': [
+            [c0, c1, 'refs/heads/master']]})
+        hooklib_spool.enqueue(self.spool, {'receivedrevs': [
+            [c1, c2, 'refs/heads/master'], ['0'*40, c1, 'refs/heads/b']]})
+        hooklib_spool.drain(self.spool, 'post-receive', [spooledhook])
+        assert(spooledhook.runs == [[(c0, c2, 'refs/heads/master'),
+                                     ('0'*40, c1, 'refs/heads/b')]])
+        assert(hooklib_spool.pending(self.spool) == [])
+
+    def test_retries(self):
+        """Only the failing hooks are retried, the pushes they still fail
+        for are kept aside"""
+        c0, c1, c2 = self.commits
+        entry = {'receivedrevs': [[c0, c1, 'refs/heads/master']]}
+        hooklib_spool.enqueue(self.spool, entry)
+        flakyhook.failures = 2
+        hooklib_spool.drain(self.spool, 'post-receive',
+                            [spooledhook, flakyhook], retrydelay=0,
+                            parallel=True)
+        assert(len(spooledhook.runs) == 1)
+        assert(flakyhook.failures == 0)
+        assert(not os.path.exists(os.path.join(self.spool, 'failed')))
+        hooklib_spool.enqueue(self.spool, entry)
+        flakyhook.failures = 3
+        hooklib_spool.drain(self.spool, 'post-receive', [flakyhook],
+                            retrydelay=0)
+        assert(hooklib_spool.pending(self.spool) == [])
+        assert(len(os.listdir(os.path.join(self.spool, 'failed'))) == 1)
+
+    def test_raising_hook(self):
+        """A hook raising an exception does not stop the spool from
+        draining"""
+        c0, c1, c2 = self.commits
+        hooklib_spool.enqueue(self.spool, {'receivedrevs': [
+            [c0, c1, 'refs/heads/master']]})
+        hooklib_spool.drain(self.spool, 'post-receive',
+                            [raisinghook, spooledhook], retrydelay=0)
+        assert(hooklib_spool.pending(self.spool) == [])
+        assert(len(os.listdir(os.path.join(self.spool, 'failed'))) == 1)
+        # the sequential runner stops at the exception
+        assert(spooledhook.runs == [])
+
+    def test_locked(self):
+        """A worker finding the spool locked leaves it to the other one"""
+        import fcntl
+        hooklib_spool.enqueue(self.spool, {'receivedrevs': []})
+        with open(os.path.join(self.spool, 'lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            hooklib_spool.drain(self.spool, 'post-receive', [spooledhook])
+        assert(spooledhook.runs == [])
+        assert(len(hooklib_spool.pending(self.spool)) == 1)
+
+    def test_detached(self):
+        c0, c1, c2 = self.commits
+        with open('hook.py', 'w') as f:
+            f.write(DETACHED_HOOK)
+        here = os.path.dirname(os.path.abspath(hooklib_spool.__file__))
+        env = dict(os.environ, PYTHONPATH=here, GIT_DIR='.git')
+        t1 = time.time()
+        proc = subprocess.Popen([sys.executable, 'hook.py'], env=env,
+                                stdin=subprocess.PIPE)
+        proc.communicate(hooklib_util.tobytes(
+            '%s %s refs/heads/master\n' % (c1, c2)))
+        assert(proc.returncode == 0)
+        assert(time.time() - t1 < 0.5)
+        assert(not os.path.exists('notified'))
+        for i in range(100):
+            if os.path.exists('notified') and \
+               not hooklib_spool.pending(self.spool):
+                break
+            time.sleep(0.1)
+        with open('notified') as f:
+            assert(f.read() == '%s %s refs/heads/master' % (c1, c2))
+        with self.assertRaises(ValueError):
+            hooklib_spool.spool('pre-receive', [spooledhook])
+
+
+class testhookserver(gitrepotestcase):
+    # Computed before setUp changes the working directory
+    client = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'hooklib_client.py')
+
+    def setUp(self):
+        super(testhookserver, self).setUp()
+        from hooklib_server import hookserver
+        self.socket = os.path.join(self.repo, 'hooklib.sock')
+        self.server = hookserver(self.socket, {
+            'pre-receive': {'hooks': [newrevshook]},
+            'update': {'hooks': [passinghook, failinghook]},
+        })
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       args=(0.05, ))
+        self.thread.start()
+        os.mkdir('hooks')
+        for phase in ('pre-receive', 'update', 'post-update'):
+            os.symlink(self.client, os.path.join('hooks', phase))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        super(testhookserver, self).tearDown()
+
+    def runhook(self, phase, args=(), stdin=''):
+        env = dict(os.environ, HOOKLIB_SOCKET=self.socket, GIT_DIR='.git')
+        proc = subprocess.Popen([sys.executable, os.path.join('hooks', phase)]
+                                + list(args), stdin=subprocess.PIPE,
+                                stderr=subprocess.PIPE, env=env)
+        out = proc.communicate(stdin.encode('utf-8'))[1]
+        return proc.returncode, hooklib_util.tostr(out)
+
+    def test_pre_receive(self):
+        new = self.committree(self.commits[2], 'message 3')
+        ret, out = self.runhook('pre-receive', stdin='%s %s refs/heads/x\n' %
+                                (self.commits[2], new))
+        assert(ret == 0)
+        assert(out == 'checking 1 revisions\n%s\n' % new)
+
+    def test_failure(self):
+        ret, out = self.runhook('update', ['refs/heads/master',
+                                           self.commits[0], self.commits[1]])
+        assert(ret == 1)
+        assert(out == ERROR_MSG + '\n')
+
+    def test_unknown_phase(self):
+        assert(self.runhook('post-update') ==
+               (1, 'no hooks for phase post-update\n'))
+
+    def test_isolation(self):
+        """The requests do not change the server"""
+        cwd, argv = os.getcwd(), sys.argv
+        self.runhook('update', ['refs/heads/master',
+                                self.commits[0], self.commits[1]])
+        assert((os.getcwd(), sys.argv) == (cwd, argv))
+        assert('GIT_DIR' not in os.environ)
+
+    def test_server_unavailable(self):
+        self.server.shutdown()
+        self.server.server_close()
+        os.unlink(self.socket)
+        ret, out = self.runhook('update')
+        assert(ret == 1)
+        assert(out.startswith('hooklib server unavailable'))
+
+    def test_untrusted_server(self):
+        """The client does not talk to a server run by another user"""
+        import hooklib_client
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.socket)
+            hooklib_client.checkserver(sock, self.socket)
+            uids = hooklib_client.serveruids
+            hooklib_client.serveruids = lambda: set([-1])
+            try:
+                self.assertRaises(socket.error, hooklib_client.checkserver,
+                                  sock, self.socket)
+            finally:
+                hooklib_client.serveruids = uids
+            # The handler forked by the server shares the socket, it would
+            # never see it closed
+            hooklib_client.sendmsg(sock, {'argv': ['post-update'], 'env': {},
+                                          'cwd': os.getcwd(), 'stdin': ''})
+            assert(hooklib_client.recvmsg(sock)['status'] == 1)
+        finally:
+            sock.close()
+
+    def test_private_dir(self):
+        from hooklib_server import makeprivatedir
+        path = os.path.join(self.repo, 'private')
+        makeprivatedir(path)
+        assert(os.stat(path).st_mode & 0o777 == 0o700)
+        makeprivatedir(path)
+        os.chmod(path, 0o777)
+        self.assertRaises(OSError, makeprivatedir, path)
+
+
+class testbench(unittest.TestCase):
+    def test_bench(self):
+        """Smoke test of the benchmark on a tiny repo"""
+        import hookbench
+        workdir = tempfile.mkdtemp()
+        try:
+            results = hookbench.runbench([10], ['sequential'], ['git'], 1,
+                                         workdir, refs=2, blobsize=100,
+                                         blobevery=5)
+        finally:
+            shutil.rmtree(workdir)
+        assert(sorted(results) == ['git/post-update/sequential/10',
+                                   'git/pre-receive/sequential/10',
+                                   'git/update/sequential/10'])
+        r = results['git/update/sequential/10']
+        assert(r['forks'] == 2)
+        assert(r['p50'] > r['parse_p50'] > 0)
+        assert(hookbench.compare(results, results, 0.2) == [])
+        slower = dict((k, dict(v, p50=v['p50'] * 2))
+                      for k, v in results.items())
+        assert(len(hookbench.compare(slower, results, 0.2)) == 3)
+
+
+# Coroutines are a syntax error for python 2, these hooks are only compiled
+# when the async runner is tested
+ASYNC_HOOKS = """
+import asyncio
+
+class asyncpassinghook(basehook):
+    async def check(self, log, revdata):
+        await asyncio.sleep(0.1)
+        return True
+
+class asyncfailinghook(basehook):
+    async def check(self, log, revdata):
+        await asyncio.sleep(0.01)
+        log.write(ERROR_MSG2)
+        return False
+
+class asyncmessagehook(basehook):
+    async def check(self, log, revdata):
+        msgs = await asyncio.gather(*[revdata.acommitmessagefor(r)
+                                      for r in revdata.revs])
+        log.write(','.join(msgs))
+        return True
+"""
+
+
+@unittest.skipIf(sys.version_info < (3, 5), "asyncio needs python 3.5")
+class testasynchookrunner(gitrepotestcase):
+    def setUp(self):
+        super(testasynchookrunner, self).setUp()
+        from hooklib_async import asynchookrunner
+        self.runnerclass = asynchookrunner
+        self.hooks = dict(globals())
+        exec(ASYNC_HOOKS, self.hooks)
+
+    def test_overlap(self):
+        """Coroutine hooks overlap on the loop, sync hooks run in threads"""
+        runner = self.runnerclass(max_workers=2)
+        for i in range(50):
+            runner.register(self.hooks['asyncpassinghook'])
+        runner.register(slowfailinghook, blocking=False)
+        runner.register(passinghook)
+        t1 = time.time()
+        assert(runner.evaluate() == False)
+        t2 = time.time()
+        assert (t2-t1) < 0.5
+        assert(runner.log.read() == [ERROR_MSG])
+        assert(runner.results[0].status == 'pass')
+
+    def test_blocking_failure(self):
+        runner = self.runnerclass(timeoutpolicy='warn')
+        runner.register(veryslowhook)
+        runner.register(self.hooks['asyncpassinghook'], timeout=0.02)
+        runner.register(self.hooks['asyncfailinghook'])
+        t1 = time.time()
+        assert(runner.evaluate() == False)
+        t2 = time.time()
+        assert (t2-t1) < 0.5
+        assert(runner.log.read() == [ERROR_MSG2])
+
+    def test_acommitmessagefor(self):
+        runner = self.runnerclass()
+        runner.revdata = gitinforesolver()
+        runner.revdata.setrevs(self.commits)
+        runner.register(self.hooks['asyncmessagehook'])
+        try:
+            assert(runner.evaluate() == True)
+        finally:
+            runner.revdata.close()
+        assert(runner.log.read() == [','.join('message %d\n\nbody %d' % (i, i)
+                                              for i in range(3))])
+
+    def test_acommitmessagefor_memo(self):
+        """The coroutine reads through the resolver, its memo included"""
+        runner = self.runnerclass()
+        runner.revdata = gitinforesolver()
+        runner.revdata.setrevs(self.commits[:1])
+        runner.revdata._memo.store(('commitmessage', self.commits[0]),
+                                   'memoized')
+        runner.register(self.hooks['asyncmessagehook'])
+        try:
+            assert(runner.evaluate() == True)
+        finally:
+            runner.revdata.close()
+        assert(runner.log.read() == ['memoized'])
+
+
 if __name__ == '__main__':
     unittest.main()
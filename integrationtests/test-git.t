@@ -131,8 +131,7 @@ All the hooks!
   >         echo "class loghook(basehook):" >> $hpath
   >         echo "    def check(self, log, revdata):" >> $hpath
   >         echo "        with open('$serverpath/res','a') as k:" >> $hpath
-  >         echo "           avalaiablevars = vars(revdata)" >> $hpath
-  >         echo "           del avalaiablevars['_revs']" >> $hpath
+  >         echo "           avalaiablevars = [k for k in vars(revdata) if not k.startswith('_')]" >> $hpath
   >         echo "           k.write('$side: $hook %s head %s\\\n' %(sorted(avalaiablevars), revdata.head))"      >> $hpath
   >         echo "        return True" >> $hpath
   >         echo "runhooks('$hook', hooks=[loghook])" >> $hpath
@@ -157,19 +156,19 @@ All the hooks!
   $ echo "op: after push" >> $serverpath/res
   $ cat $serverpath/res
   op: before first commit
-  client: pre-commit ['reporoot'] head * (glob)
-  client: prepare-commit-msg ['messagefile', 'mode', 'reporoot', 'sha'] head * (glob)
-  client: commit-msg ['messagefile', 'reporoot'] head * (glob)
-  client: post-commit ['reporoot'] head * (glob)
+  client: pre-commit [] head * (glob)
+  client: prepare-commit-msg ['messagefile', 'mode', 'sha'] head * (glob)
+  client: commit-msg ['messagefile'] head * (glob)
+  client: post-commit [] head * (glob)
   op: after first commit
   op: before second commit
-  client: pre-commit ['reporoot'] head * (glob)
-  client: prepare-commit-msg ['messagefile', 'mode', 'reporoot', 'sha'] head * (glob)
+  client: pre-commit [] head * (glob)
+  client: prepare-commit-msg ['messagefile', 'mode', 'sha'] head * (glob)
   op: after second commit
   op: before push
-  client: pre-push ['reporoot', 'revstobepushed'] head * (glob)
-  server: pre-receive ['receivedrevs', 'reporoot'] head * (glob)
-  server: update ['new', 'old', 'refname', 'reporoot'] head * (glob)
-  server: post-receive ['receivedrevs', 'reporoot'] head * (glob)
-  server: post-update ['reporoot'] head * (glob)
+  client: pre-push ['revstobepushed'] head * (glob)
+  server: pre-receive ['receivedrevs'] head * (glob)
+  server: update ['new', 'old', 'refname'] head * (glob)
+  server: post-receive ['receivedrevs'] head * (glob)
+  server: post-update ['revs'] head * (glob)
   op: after push
@@ -15,6 +15,9 @@ setup(
     description="Hook helper library in python",
     keywords="hooks",
     license='Apache 2.0',
-    py_modules=['hooklib', 'hooklib_git', 'hooklib_input', 'hooklib_hg'],
+    py_modules=['hooklib', 'hooklib_git', 'hooklib_input', 'hooklib_hg',
+                'hooklib_util', 'hooklib_async', 'hooklib_cache',
+                'hooklib_server', 'hooklib_client', 'hooklib_gitodb',
+                'hooklib_spool'],
     **extra
 )